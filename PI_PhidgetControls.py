@@ -19,39 +19,133 @@
     9. Open settings, Keyboard, bind fscode/phidgetcontrols/* actions to select interaction mode
 
     Customization:
-    1. File PhidgetControlsConfig.py contains the configuration of phidgets and manipulators
+    1. File PhidgetControlsConfig.json contains the configuration of phidgets and manipulators, reloaded on change
 
 """
 import logging
+import re
+from collections import deque, OrderedDict
+from inspect import getargspec
 from time import time
+from timeit import default_timer
 from logging import Handler
 from traceback import format_exception, format_exc
 
 from XPLMProcessing import XPLMCreateFlightLoop, XPLMScheduleFlightLoop, XPLMDestroyFlightLoop
-from XPLMDataAccess import XPLMFindDataRef, XPLMGetDatai, XPLMSetDatai, XPLMGetDataf, XPLMSetDataf
-from XPLMUtilities import XPLMDebugString, XPLMFindCommand, XPLMCommandOnce, XPLMCreateCommand, \
+from XPLMPlugin import XPLM_MSG_PLANE_LOADED
+from XPLMPlanes import XPLMGetNthAircraftModel
+from XPLMDataAccess import XPLMGetDatai, XPLMSetDatai, XPLMGetDataf, XPLMSetDataf
+from XPLMUtilities import XPLMDebugString, XPLMCreateCommand, \
     XPLMRegisterCommandHandler, XPLMUnregisterCommandHandler
 from SandyBarbourUtilities import SandyBarbourPrint
 from Phidget22 import Phidget
 from Phidget22.PhidgetException import PhidgetException
-from typing import Optional, Union, List
+from Phidget22.LCDFont import LCDFont
+from typing import Optional, Union, List, Dict, Tuple
 from operator import add, sub
-from PhidgetControlsCache import get_phidget, close_all_phidgets, log_phidget_exception, ensure_phidgets_opened
+import PhidgetControlsCache
+import PhidgetControlsConfig
+from PhidgetControlsConfig import load_config, config_changed, select_profile
+from PhidgetControlsCache import get_input, get_output, OutputPhidget, flush_outputs, close_all_phidgets, \
+    log_phidget_exception, drain_inputs, input_channels, start_connection_manager, open_phidgets
+from PhidgetControlsInput import InputChannel, Device
+import PhidgetControlsStats
+from PhidgetControlsStats import add_loop, add_tick, count, log_stats, publish_stats, unpublish_stats
+import PhidgetControlsRecorder
+from PhidgetControlsRecorder import Recorder
+from PhidgetControlsDataRefs import get_dataref, set_dataref, flush_datarefs, find_dataref, find_command, \
+    invalidate_handles, queue_command, flush_commands, throttled, release_throttled, ThrottledDataRef
 
 # Configuration: Global defaults
 FLIGHT_LOOP_TIMER = 0.01
 FLIGHT_LOOP_SEQUENCE = 0
+ACTIVE_MODE = 'none'
+
+# Configuration: flight loop timer while no input changed for FLIGHT_LOOP_IDLE_AFTER seconds (event input only),
+# timers in seconds or negative for number of frames (e.g. -1 for every frame)
+FLIGHT_LOOP_IDLE_TIMER = 0.1
+FLIGHT_LOOP_IDLE_AFTER = 2.0
+
+# Configuration: seconds between checks of PhidgetControlsConfig.json for changes
+CONFIG_CHECK_INTERVAL = 1.0
+
+# Configuration: aircraft profiles kept compiled for switching back to recent aircraft
+PROFILE_CACHE_SIZE = 4
+
+# Configuration: log level, and queueing of log records written a few per flight loop with identical messages
+# suppressed for LOG_REPEAT_INTERVAL seconds
+LOG_LEVEL = logging.INFO
+LOG_QUEUE_SIZE = 256
+LOG_RECORDS_PER_LOOP = 8
+LOG_REPEAT_INTERVAL = 10.0
+
+# Configuration: gesture timing in seconds - presses shorter than CLICK_TIME are clicks, two clicks within
+# DOUBLE_CLICK_TIME a double click, presses held for LONG_PRESS_TIME a long press
+CLICK_TIME = 0.2
+DOUBLE_CLICK_TIME = 0.4
+LONG_PRESS_TIME = 0.8
+
+# Configuration: seconds of position changes to estimate encoder velocity from for acceleration
+ACCELERATION_WINDOW = 0.1
+
+# Configuration: LCD font (Phidget22 LCDFont) and characters per row
+LCD_FONT = LCDFont.FONT_5x8
+LCD_COLUMNS = 20
+
+CLICK, SINGLE_CLICK, DOUBLE_CLICK, LONG_PRESS, HOLD_REPEAT = 'click', 'single click', 'double click', \
+    'long press', 'hold repeat'
+
+# kinds of interaction arguments in declarations - size is a positive number, format a text with one conversion
+PHIDGET, INTERACTION, TEXT, FORMAT, NUMBER, SIZE, INTEGER, CURVE = 'phidget', 'interaction', 'text', 'format', \
+    'number', 'size', 'integer', 'curve'
 
 Number = Union[float, int]
 
 
 class XPlaneLogger(Handler):
+    """
+        Queues log records from any thread - written to X-Plane's log from the flight loop via flush()
+    """
 
     def __init__(self):
         Handler.__init__(self)
+        self.queue = deque()
+        self.dropped = 0
+        self.repeats = {}  # type: Dict[str, list]
 
     def emit(self, record):
-        msg = record.getMessage()
+        msg = self.format(record)
+
+        # identical message logged recently? just count it
+        repeat = self.repeats.get(msg)
+        if repeat and record.created - repeat[0] < LOG_REPEAT_INTERVAL:
+            repeat[1] += 1
+            return
+        if len(self.repeats) >= LOG_QUEUE_SIZE:
+            self.repeats.clear()
+        self.repeats[msg] = [record.created, 0]
+        if repeat and repeat[1]:
+            msg = '%s (repeated %i times)' % (msg, repeat[1])
+
+        # bounded queue
+        if len(self.queue) >= LOG_QUEUE_SIZE:
+            self.dropped += 1
+            return
+        self.queue.append(msg)
+
+    def flush(self, limit=None):
+        # type: (Optional[int]) -> None
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self.write('%i log messages dropped' % dropped)
+        while self.queue and limit != 0:
+            self.write(self.queue.popleft())
+            if limit:
+                limit -= 1
+
+    # noinspection PyMethodMayBeStatic
+    def write(self, msg):
+        # type: (str) -> None
         XPLMDebugString("%s: %s\n" % ('PhidgetControls', msg))
         SandyBarbourPrint("%s: %s" % ('PhidgetControls', msg))
 
@@ -76,6 +170,17 @@ class RelativePositionProducer(PositionProducer):
         self.starting_position = None
         self.last_position = None
         self.last_loop_sequence = None
+        # channels are only looked at when changed - keep in sequence with those changes instead of loops
+        self.sequenced = isinstance(position_producer, InputChannel)
+
+    def reset(self):
+        self.starting_position = None
+        self.last_position = None
+        self.last_loop_sequence = None
+        # channels hold their current position - start from it so the next change counts
+        if self.sequenced:
+            self.starting_position = self.last_position = self.position_producer.position
+            self.last_loop_sequence = self.position_producer.sequence
 
     def getPosition(self):
 
@@ -83,18 +188,19 @@ class RelativePositionProducer(PositionProducer):
         new_position = self.position_producer.getPosition()
         if not new_position:
             return None
+        loop_sequence = self.position_producer.sequence if self.sequenced else FLIGHT_LOOP_SEQUENCE
 
         # first position? starting offset
-        if not self.starting_position:
+        if self.starting_position is None:
             self.starting_position = new_position
             self.last_position = new_position
-            self.last_loop_sequence = FLIGHT_LOOP_SEQUENCE
+            self.last_loop_sequence = loop_sequence
             return 0
 
         # are we not in sequence anymore and need to start fresh?
-        if self.last_loop_sequence != FLIGHT_LOOP_SEQUENCE-1:
+        if self.last_loop_sequence != loop_sequence-1:
             self.starting_position = new_position-(self.last_position-self.starting_position)
-        self.last_loop_sequence = FLIGHT_LOOP_SEQUENCE
+        self.last_loop_sequence = loop_sequence
 
         # calculate relative to starting position
         self.last_position = new_position
@@ -126,7 +232,9 @@ class DeltaProducer(object):
         self.position = None
 
     def reset(self):
-        self.position = None
+        if hasattr(self.position_producer, 'reset'):
+            self.position_producer.reset()
+        self.position = current_position(self.position_producer)
 
     def getDelta(self):
         # type: () -> int
@@ -144,6 +252,71 @@ class DeltaProducer(object):
         return delta
 
 
+class AcceleratedDeltaProducer(object):
+    """
+        Scales deltas along a curve of [velocity, factor] points - velocity in positions per second estimated
+        from timestamped position changes over the last ACCELERATION_WINDOW seconds
+    """
+
+    def __init__(self, delta_producer, position_producer, curve):
+        # type: (DeltaProducer, PositionProducer, List[ Tuple[Number, Number]]) -> None
+        self.delta_producer = delta_producer
+        self.position_producer = position_producer
+        self.curve = sorted((float(velocity), float(factor)) for velocity, factor in curve)
+        if not self.curve:
+            raise ValueError('Expected [[velocity, factor], ...] but got %r' % (curve,))
+        # channels carry timestamped changes, anything else is sampled
+        self.timestamped = isinstance(position_producer, InputChannel)
+        self.changes = deque()  # type: deque
+        self.total = 0
+        self.position = None
+
+    def reset(self):
+        self.delta_producer.reset()
+        self.changes.clear()
+        self.total = 0
+        self.position = None
+
+    def getVelocity(self, now):
+        # type: (float) -> float
+        if self.timestamped:
+            for timestamp, position_change in self.position_producer.changes:
+                self.changes.append((timestamp, abs(position_change)))
+                self.total += abs(position_change)
+        else:
+            position = self.position_producer.getPosition()
+            if position is not None and self.position is not None and position != self.position:
+                self.changes.append((now, abs(position - self.position)))
+                self.total += abs(position - self.position)
+            self.position = position
+
+        # forget changes outside of window
+        while self.changes and self.changes[0][0] < now - ACCELERATION_WINDOW:
+            self.total -= self.changes.popleft()[1]
+        return self.total / ACCELERATION_WINDOW
+
+    def getFactor(self, velocity):
+        # type: (float) -> float
+        # interpolate linearly between points, flat outside
+        previous_velocity, previous_factor = self.curve[0]
+        if velocity <= previous_velocity:
+            return previous_factor
+        for point_velocity, point_factor in self.curve[1:]:
+            if velocity <= point_velocity:
+                return previous_factor + (point_factor - previous_factor) * (velocity - previous_velocity) / (
+                    point_velocity - previous_velocity)
+            previous_velocity, previous_factor = point_velocity, point_factor
+        return previous_factor
+
+    def getDelta(self):
+        # type: () -> int
+        velocity = self.getVelocity(time())
+        delta = self.delta_producer.getDelta()
+        if not delta:
+            return delta
+        return int(round(delta * self.getFactor(velocity))) or delta
+
+
 class NotchedPositionProducer(PositionProducer):
     def __init__(self, position_producer, notch_size):
         # type: (PositionProducer, int) -> None
@@ -152,7 +325,9 @@ class NotchedPositionProducer(PositionProducer):
         self.position = None
 
     def reset(self):
-        self.position = None
+        if hasattr(self.position_producer, 'reset'):
+            self.position_producer.reset()
+        self.position = current_position(self.position_producer)
 
     # get position
     def getPosition(self):
@@ -179,76 +354,302 @@ class NotchedPositionProducer(PositionProducer):
         return int(self.position / self.notch_size)
 
 
-class ClickProducer(object):
-    def __init__(self, digital_input_producer):
-        # type: (StateProducer) -> None
-        self.digital_input_producer = digital_input_producer
-        self.state = None  # type: Union[bool, None]
-        self.first_press = None
+class NotchedDeltaProducer(object):
+    """
+        DeltaProducer(NotchedPositionProducer(position_producer, notch_size)), with RelativePositionProducer in
+        between if relative, fused into one object - same deltas with integer notch arithmetic
+    """
 
-    # get delta change
-    def isClicked(self):
+    __slots__ = ('position_producer', 'notch_size', 'half_notch', 'relative', 'sequenced', 'starting_position',
+                 'last_position', 'last_loop_sequence', 'notched_position', 'position')
 
-        new_state = self.digital_input_producer.getState()
+    def __init__(self, position_producer, notch_size, relative=False):
+        # type: (PositionProducer, int, bool) -> None
+        self.position_producer = position_producer
+        self.notch_size = notch_size
+        self.half_notch = notch_size // 2
+        self.relative = relative
+        self.sequenced = isinstance(position_producer, InputChannel)
+        self.starting_position = None
+        self.last_position = None
+        self.last_loop_sequence = None
+        self.notched_position = None
+        self.position = None
 
-        if new_state is None:
-            return None
+    def reset(self):
+        self.starting_position = None
+        self.last_position = None
+        self.last_loop_sequence = None
+        self.notched_position = None
+        self.position = None
 
-        if new_state == 0:
-            if self.first_press is None:
-                return False
-            result =  time() - self.first_press < 0.2
-            self.first_press = None
-            return result
-        else:
-            if self.first_press is None:
-                self.first_press = time()
+        # channels hold their current position - start from it so the next change counts
+        if self.sequenced:
+            new_position = self.position_producer.position
+            if self.relative:
+                self.starting_position = self.last_position = new_position
+                self.last_loop_sequence = self.position_producer.sequence
+                new_position = 0
+            self.notched_position = new_position
+            self.position = new_position // self.notch_size
+
+    def getDelta(self):
+        # type: () -> int
+        producer = self.position_producer
+        new_position = producer.position if self.sequenced else producer.getPosition()
+        if not new_position:
             return 0
 
+        # relative to starting position, in sequence with changes (channels) or flight loops
+        if self.relative:
+            loop_sequence = producer.sequence if self.sequenced else FLIGHT_LOOP_SEQUENCE
+            if self.starting_position is None:
+                self.starting_position = self.last_position = new_position
+                self.last_loop_sequence = loop_sequence
+                return 0
+            if self.last_loop_sequence != loop_sequence - 1:
+                self.starting_position = new_position - (self.last_position - self.starting_position)
+            self.last_loop_sequence = loop_sequence
+            self.last_position = new_position
+            new_position -= self.starting_position
+            if not new_position:
+                return 0
+
+        # follow inside notch, to the closest notch otherwise
+        notched_position = self.notched_position
+        if new_position != notched_position:
+            if notched_position is None or new_position % self.notch_size < self.half_notch:
+                notched_position = new_position
+            elif new_position < notched_position:
+                notched_position = new_position + self.half_notch
+            else:
+                notched_position = new_position - self.half_notch
+            self.notched_position = notched_position
+        position = notched_position // self.notch_size
+
+        # first result ever?
+        if self.position is None:
+            self.position = position
+            return 0
+        delta = self.position - position
+        self.position = position
+        return delta
+
+
+def current_position(position_producer):
+    # type: (PositionProducer) -> Optional[int]
+    # position of a producer as of the last drain of its channel, None unless reading a channel (no device I/O)
+    if isinstance(position_producer, InputChannel):
+        return position_producer.position
+    if isinstance(position_producer, RelativePositionProducer) and position_producer.sequenced:
+        return 0
+    if isinstance(position_producer, NotchedPositionProducer) and position_producer.position is not None:
+        return int(position_producer.position / position_producer.notch_size)
+    return None
+
+
+def notched_delta_producer(position_producer, notch_size, relative=False):
+    # type: (PositionProducer, Number, bool) -> Union[NotchedDeltaProducer, DeltaProducer]
+    # fused for integer notches, stages otherwise (int() of a float division truncates rather than floors)
+    if isinstance(notch_size, (int, long)):
+        return NotchedDeltaProducer(position_producer, notch_size, relative)
+    if relative:
+        position_producer = RelativePositionProducer(position_producer)
+    return DeltaProducer(NotchedPositionProducer(position_producer, notch_size))
+
+
+class GestureProducer(object):
+    """
+        Recognizes gestures from timestamped state edges - so presses shorter than a flight loop aren't missed
+    """
+
+    def __init__(self, state_producer, double_click_time=None, long_press_time=None, repeat_time=None):
+        # type: (StateProducer, Optional[float], Optional[float], Optional[float]) -> None
+        self.state_producer = state_producer
+        self.double_click_time = double_click_time
+        self.long_press_time = long_press_time
+        self.repeat_time = repeat_time
+        # channels carry timestamped edges, anything else is sampled
+        self.timestamped = isinstance(state_producer, InputChannel)
+        self.state = False
+        self.pressed = None  # type: Optional[float]
+        self.held = 0
+        self.clicked = None  # type: Optional[float]
+
+    def reset(self):
+        self.state = False
+        self.pressed = None
+        self.held = 0
+        self.clicked = None
+
+    def getEdges(self):
+        # type: () -> List[ (float, object)]
+        if self.timestamped:
+            return self.state_producer.changes
+        state = self.state_producer.getState()
+        if state is None or bool(state) == self.state:
+            return []
+        return [(time(), state)]
+
+    def getGestures(self):
+        # type: () -> List[str]
+        gestures = []
+
+        for timestamp, state in self.getEdges():
+            state = bool(state)
+            if state == self.state:
+                continue
+            self.state = state
+
+            # pressed? wait for release
+            if state:
+                self.pressed = timestamp
+                self.held = 0
+                continue
+
+            # released after long press not yet recognized?
+            duration = timestamp - self.pressed
+            self.pressed = None
+            if self.long_press_time is not None and not self.held and duration >= self.long_press_time:
+                gestures.append(LONG_PRESS)
+
+            # too long for a click? any click before stays single
+            if self.held or duration >= CLICK_TIME:
+                if self.clicked is not None:
+                    gestures.append(SINGLE_CLICK)
+                    self.clicked = None
+                continue
+
+            gestures.append(CLICK)
+            if self.double_click_time is None:
+                continue
+            if self.clicked is not None and timestamp - self.clicked < self.double_click_time:
+                gestures.append(DOUBLE_CLICK)
+                self.clicked = None
+            else:
+                if self.clicked is not None:
+                    gestures.append(SINGLE_CLICK)
+                self.clicked = timestamp
+
+        now = time()
+
+        # held long enough for long press or next repeat?
+        if self.pressed is not None and self.long_press_time is not None and (not self.held or self.repeat_time):
+            if now >= self.pressed + self.long_press_time + self.held * (self.repeat_time or 0):
+                gestures.append(HOLD_REPEAT if self.held else LONG_PRESS)
+                self.held += 1
+
+        # no second click in time?
+        if self.clicked is not None and self.pressed is None and now - self.clicked >= self.double_click_time:
+            gestures.append(SINGLE_CLICK)
+            self.clicked = None
+
+        return gestures
+
+    def isPending(self):
+        # type: () -> bool
+        # gestures still to be recognized over time without further edges?
+        if self.clicked is not None:
+            return True
+        return self.pressed is not None and self.long_press_time is not None and (not self.held or self.repeat_time)
+
 
 class Interaction(object):
 
-    @staticmethod
-    def _getPhidget(phidget):
+    inputs = ()  # type: Tuple[Device, ...]
+    outputs = ()  # type: Tuple[Device, ...]
+
+    # kinds of arguments in order of __init__'s, and type of phidget declared first if restricted (e.g. LCD for
+    # interactions writing text)
+    arguments = ()  # type: Tuple[str, ...]
+    phidget_type = None  # type: Optional[str]
+
+    def _getPhidget(self, phidget):
         # type: ( str ) -> Phidget
-        from PhidgetControlsConfig import PHIDGETS
+        key = PhidgetControlsConfig.PHIDGETS[phidget]
+
+        # remember what phidgets this interaction consumes
+        self.inputs += (key,)
 
-        phidget_type, phidget_id = PHIDGETS[phidget]  # type: (type[Phidget], int)
-        return get_phidget(phidget_type, phidget_id)
+        return get_input(key)
+
+    def _getOutput(self, phidget):
+        # type: ( str ) -> OutputPhidget
+        key = PhidgetControlsConfig.PHIDGETS[phidget]
+
+        # remember what phidgets this interaction shows on - ticked every flight loop
+        self.outputs += (key,)
+
+        return get_output(key)
 
     def tick(self):
+        # returns True to be ticked again next flight loop even without input changes
         pass
 
+    def reset(self):
+        # start over from current input - the next change of a channel counts in full
+        for producer in (getattr(self, 'delta_producer', None), getattr(self, 'gesture_producer', None)):
+            if producer:
+                producer.reset()
+        # nothing held back from before - what's held is written with the next flush
+        ref = getattr(self, 'ref', None)
+        if isinstance(ref, ThrottledDataRef):
+            release_throttled(ref)
+
 
 class If(Interaction):
+
+    arguments = (PHIDGET, INTERACTION)
+
     def __init__(self, state_producer, interaction):
         self.if_state_producer = self._getPhidget(state_producer)
         self.interaction = interaction
+        self.inputs += interaction.inputs
+        self.outputs += interaction.outputs
+        self.active = None  # type: Optional[bool]
+
+    def isActive(self):
+        # type: () -> bool
+        return bool(self.if_state_producer.getState())
 
     def tick(self):
-        if self.if_state_producer.getState():
-            self.interaction.tick()
+        if not self.isActive():
+            self.active = False
+            return
+        # condition just met? start over from current input rather than catch up on input changed meanwhile
+        if self.active is False:
+            self.interaction.reset()
+        self.active = True
+        return self.interaction.tick()
 
+    def reset(self):
+        self.interaction.reset()
+        # channels hold their current state - started over already if the condition is met
+        self.active = self.isActive() if isinstance(self.if_state_producer, InputChannel) else None
 
-class Unless(Interaction):
-    def __init__(self, state_producer, interaction):
-        self.if_state_producer = self._getPhidget(state_producer)
-        self.interaction = interaction
 
-    def tick(self):
-        if not self.if_state_producer.getState():
-            self.interaction.tick()
+class Unless(If):
+
+    def isActive(self):
+        # type: () -> bool
+        return not self.if_state_producer.getState()
 
 
 class Rotate(Interaction):
-    def __init__(self, position_producer_id, notch_size, xref, min_value, max_value, step):
-        # type: (str, int, str, Number, Number, Number) -> None
-        self.delta_producer = DeltaProducer(NotchedPositionProducer(
-            RelativePositionProducer(self._getPhidget(position_producer_id)), notch_size))
+
+    arguments = (PHIDGET, SIZE, TEXT, NUMBER, NUMBER, NUMBER, CURVE, NUMBER)
+
+    def __init__(self, position_producer_id, notch_size, xref, min_value, max_value, step, acceleration=None,
+                 max_rate=None):
+        # type: (str, int, str, Number, Number, Number, Optional[list], Optional[Number]) -> None
+        phidget = self._getPhidget(position_producer_id)
+        self.delta_producer = notched_delta_producer(phidget, notch_size, relative=True)
+        if acceleration:
+            self.delta_producer = AcceleratedDeltaProducer(self.delta_producer, phidget, acceleration)
         self.min_value = min_value
         self.max_value = max_value
         self.step = step
-        self.ref = XPLMFindDataRef(xref)
+        self.ref = throttled(find_dataref(xref), max_rate)
         if isinstance(min_value, float):
             self.getter = XPLMGetDataf
             self.setter = XPLMSetDataf
@@ -261,17 +662,20 @@ class Rotate(Interaction):
         delta = self.delta_producer.getDelta()
         if not delta:
             return
-        val = self.getter(self.ref) + (delta * self.step)
+        val = get_dataref(self.ref, self.getter) + (delta * self.step)
         val = self.min_value + ((val - self.min_value) % (self.max_value - self.min_value))
-        self.setter(self.ref, val)
+        set_dataref(self.ref, self.setter, val)
 
 
 class SetDigit(Interaction):
-    def __init__(self, position_producer, xref, digit):
-        # type: (str, str, int) -> None
-        self.delta_producer = DeltaProducer(NotchedPositionProducer(self._getPhidget(position_producer), 10))
+
+    arguments = (PHIDGET, TEXT, INTEGER, NUMBER)
+
+    def __init__(self, position_producer, xref, digit, max_rate=None):
+        # type: (str, str, int, Optional[Number]) -> None
+        self.delta_producer = notched_delta_producer(self._getPhidget(position_producer), 10)
         self.digit = digit
-        self.ref = XPLMFindDataRef(xref)
+        self.ref = throttled(find_dataref(xref), max_rate)
         self.getter = XPLMGetDatai
         self.setter = XPLMSetDatai
 
@@ -279,24 +683,29 @@ class SetDigit(Interaction):
         delta = self.delta_producer.getDelta()
         if not delta:
             return
-        val = self.getter(self.ref)
+        val = get_dataref(self.ref, self.getter)
         increment_digit = 10 ** (self.digit - 1)
         modulo = increment_digit * 10
         remainder = (val + delta * increment_digit) % modulo
         quotient = int(val / modulo) * modulo
         val = quotient + remainder
-        self.setter(self.ref, val)
+        set_dataref(self.ref, self.setter, val)
 
 
 class SetValue(Interaction):
 
-    def __init__(self, position_producer, xref, increment, min_value, max_value):
-        # type: (Phidget, str, str, Number, Number, Number) -> None
-        self.delta_producer = DeltaProducer(NotchedPositionProducer(self._getPhidget(position_producer), 10))
+    arguments = (PHIDGET, TEXT, NUMBER, NUMBER, NUMBER, CURVE, NUMBER)
+
+    def __init__(self, position_producer, xref, increment, min_value, max_value, acceleration=None, max_rate=None):
+        # type: (Phidget, str, str, Number, Number, Number, Optional[list], Optional[Number]) -> None
+        phidget = self._getPhidget(position_producer)
+        self.delta_producer = notched_delta_producer(phidget, 10)
+        if acceleration:
+            self.delta_producer = AcceleratedDeltaProducer(self.delta_producer, phidget, acceleration)
         self.increment = increment
         self.min = min_value
         self.max = max_value
-        self.ref = XPLMFindDataRef(xref)
+        self.ref = throttled(find_dataref(xref), max_rate)
         self.use_float = isinstance(increment, float)
         if self.use_float:
             self.getter = XPLMGetDataf
@@ -309,52 +718,222 @@ class SetValue(Interaction):
         delta = self.delta_producer.getDelta()
         if not delta:
             return
-        val = min(self.max, max(self.min, self.getter(self.ref) + delta * self.increment))
-        self.setter(self.ref, val)
+        val = min(self.max, max(self.min, get_dataref(self.ref, self.getter) + delta * self.increment))
+        set_dataref(self.ref, self.setter, val)
 
 
 class Tune(Rotate):
-    def __init__(self, position_producer_id, xref, min_value, max_value, inc):
-        # type: (str, str, Number, Number, Number) -> None
-        Rotate.__init__(self, position_producer_id, 10, xref, min_value, max_value, inc)
+
+    arguments = (PHIDGET, TEXT, NUMBER, NUMBER, NUMBER, CURVE, NUMBER)
+
+    def __init__(self, position_producer_id, xref, min_value, max_value, inc, acceleration=None, max_rate=None):
+        # type: (str, str, Number, Number, Number, Optional[list], Optional[Number]) -> None
+        Rotate.__init__(self, position_producer_id, 10, xref, min_value, max_value, inc, acceleration, max_rate)
 
 
 class SetHeading(Rotate):
-    def __init__(self, position_producer_id, xref):
-        # type: (str, str) -> None
-        Rotate.__init__(self, position_producer_id, 2, xref, 0.0, 360.0, 1.0)
+
+    arguments = (PHIDGET, TEXT, CURVE, NUMBER)
+
+    def __init__(self, position_producer_id, xref, acceleration=None, max_rate=None):
+        # type: (str, str, Optional[list], Optional[Number]) -> None
+        Rotate.__init__(self, position_producer_id, 2, xref, 0.0, 360.0, 1.0, acceleration, max_rate)
 
 
 class SetBearing(Rotate):
-    def __init__(self, position_producer_id, xref):
-        # type: (str, str) -> None
-        Rotate.__init__(self, position_producer_id, 2, xref, 0.0, 360.0, 1.0)
+
+    arguments = (PHIDGET, TEXT, CURVE, NUMBER)
+
+    def __init__(self, position_producer_id, xref, acceleration=None, max_rate=None):
+        # type: (str, str, Optional[list], Optional[Number]) -> None
+        Rotate.__init__(self, position_producer_id, 2, xref, 0.0, 360.0, 1.0, acceleration, max_rate)
 
 
 class Click(Interaction):
+
+    gestures = (CLICK,)
+    arguments = (PHIDGET, TEXT)
+
     def __init__(self, state_producer_id, xref):
         # type: (str, str) -> None
-        self.click_producer = ClickProducer(self._getPhidget(state_producer_id))
-        self.ref = XPLMFindCommand(xref)
+        self.gesture_producer = GestureProducer(self._getPhidget(state_producer_id))
+        self.ref = find_command(xref)
 
     def tick(self):
-        if self.click_producer.isClicked():
-            XPLMCommandOnce(self.ref)
+        # type: () -> bool
+        for gesture in self.gesture_producer.getGestures():
+            if gesture in self.gestures:
+                queue_command(self.ref)
+        return self.gesture_producer.isPending()
+
+
+class SingleClick(Click):
+
+    gestures = (SINGLE_CLICK,)
+    arguments = (PHIDGET, TEXT, NUMBER)
+
+    def __init__(self, state_producer_id, xref, double_click_time=None):
+        # type: (str, str, Optional[float]) -> None
+        self.gesture_producer = GestureProducer(self._getPhidget(state_producer_id),
+                                                double_click_time=double_click_time or DOUBLE_CLICK_TIME)
+        self.ref = find_command(xref)
+
+
+class DoubleClick(SingleClick):
+
+    gestures = (DOUBLE_CLICK,)
+
+
+class LongPress(Click):
+
+    gestures = (LONG_PRESS, HOLD_REPEAT)
+    arguments = (PHIDGET, TEXT, NUMBER, NUMBER)
+
+    def __init__(self, state_producer_id, xref, long_press_time=None, repeat_time=None):
+        # type: (str, str, Optional[float], Optional[float]) -> None
+        self.gesture_producer = GestureProducer(self._getPhidget(state_producer_id),
+                                                long_press_time=long_press_time or LONG_PRESS_TIME,
+                                                repeat_time=repeat_time)
+        self.ref = find_command(xref)
 
 
 class UpDown(Interaction):
+
+    arguments = (PHIDGET, TEXT, TEXT)
+
     def __init__(self, position_producer_id, up, down):
         # type: (str, str, str) -> None
-        self.delta_producer = DeltaProducer(NotchedPositionProducer(self._getPhidget(position_producer_id), 20))
-        self.up = XPLMFindCommand(up)
-        self.down = XPLMFindCommand(down)
+        self.delta_producer = notched_delta_producer(self._getPhidget(position_producer_id), 20)
+        self.up = find_command(up)
+        self.down = find_command(down)
 
     def tick(self):
         delta = self.delta_producer.getDelta()
         if delta < 0:
-            XPLMCommandOnce(self.up)
+            queue_command(self.up, -delta, self.down)
         if delta > 0:
-            XPLMCommandOnce(self.down)
+            queue_command(self.down, delta, self.up)
+
+
+class ShowMode(Interaction):
+
+    arguments = (PHIDGET, INTEGER)
+    phidget_type = 'LCD'
+
+    def __init__(self, lcd_id, row=0):
+        # type: (str, int) -> None
+        self.lcd = self._getOutput(lcd_id)
+        self.row = row
+
+    def tick(self):
+        self.lcd.set('writeText', (LCD_FONT, 0, self.row), ACTIVE_MODE[:LCD_COLUMNS].ljust(LCD_COLUMNS))
+
+
+class ShowValue(Interaction):
+
+    arguments = (PHIDGET, TEXT, FORMAT, INTEGER)
+    phidget_type = 'LCD'
+
+    def __init__(self, lcd_id, xref, text_format='%s', row=1):
+        # type: (str, str, str, int) -> None
+        self.lcd = self._getOutput(lcd_id)
+        self.ref = find_dataref(xref)
+        self.text_format = text_format
+        self.row = row
+        # read as int for integer conversions like %d
+        conversion = re.search(r'%[-+ #0-9.]*([a-zA-Z])', text_format)
+        self.getter = XPLMGetDatai if conversion and conversion.group(1) in 'dixXc' else XPLMGetDataf
+
+    def tick(self):
+        text = self.text_format % get_dataref(self.ref, self.getter)
+        self.lcd.set('writeText', (LCD_FONT, 0, self.row), text[:LCD_COLUMNS].ljust(LCD_COLUMNS))
+
+
+class Light(Interaction):
+
+    arguments = (PHIDGET, TEXT, NUMBER, NUMBER)
+    phidget_type = 'DigitalOutput'
+
+    def __init__(self, output_id, xref, on_value=None, brightness=None):
+        # type: (str, str, Optional[Number], Optional[float]) -> None
+        self.output = self._getOutput(output_id)
+        self.ref = find_dataref(xref)
+        self.on_value = on_value
+        self.brightness = brightness
+        self.getter = XPLMGetDataf if isinstance(on_value, float) else XPLMGetDatai
+
+    def tick(self):
+        value = get_dataref(self.ref, self.getter)
+        state = bool(value) if self.on_value is None else value == self.on_value
+        if self.brightness is None:
+            self.output.set('setState', (), state)
+        else:
+            self.output.set('setDutyCycle', (), self.brightness if state else 0.0)
+
+
+# interaction types available to declarations by name
+INTERACTION_TYPES = dict((interaction_type.__name__, interaction_type) for interaction_type in [
+    If, Unless, Rotate, SetDigit, SetValue, Tune, SetHeading, SetBearing, Click, SingleClick,
+    DoubleClick, LongPress, UpDown, ShowMode, ShowValue, Light])
+
+
+def validate_declaration(declaration, phidgets):
+    # type: (list, Dict[str, tuple]) -> tuple
+    # check declaration [type, phidget, arguments...] with nested declarations for arguments
+    if not isinstance(declaration, (list, tuple)) or not declaration or declaration[0] not in INTERACTION_TYPES:
+        raise ValueError('Expected [%s, arguments...] but got %r' % ('|'.join(sorted(INTERACTION_TYPES)), declaration))
+    interaction_type = INTERACTION_TYPES[declaration[0]]
+    args, _, _, defaults = getargspec(interaction_type.__init__)
+    if not len(args) - 1 - len(defaults or ()) <= len(declaration) - 1 <= len(args) - 1:
+        raise ValueError('Expected %s(%s) but got %r' % (interaction_type.__name__, ', '.join(args[1:]), declaration))
+    # arguments of their kind, optional ones (those with defaults) may be null
+    required = len(args) - 1 - len(defaults or ())
+    for index, (arg, kind) in enumerate(zip(declaration[1:], interaction_type.arguments)):
+        if kind == PHIDGET and isinstance(arg, basestring) and arg not in phidgets:
+            raise LookupError('No phidget %s in %r' % (arg, declaration))
+        if not (arg is None and index >= required) and not _is_kind(arg, kind):
+            raise ValueError('Expected %s %s but got %r in %r' % (kind, args[index + 1], arg, declaration))
+    if interaction_type.phidget_type and phidgets[declaration[1]][0] != interaction_type.phidget_type:
+        raise ValueError('Expected %s phidget but got %s %s in %r' % (
+            interaction_type.phidget_type, phidgets[declaration[1]][0], declaration[1], declaration))
+    return tuple([validate_declaration(arg, phidgets) if kind == INTERACTION else arg
+                  for arg, kind in zip(declaration, (None,) + interaction_type.arguments)])
+
+
+def _is_kind(arg, kind):
+    # type: (object, str) -> bool
+    if kind == INTERACTION:
+        return _is_declaration(arg)
+    if kind in (PHIDGET, TEXT):
+        return isinstance(arg, basestring)
+    if kind == FORMAT:
+        try:
+            return isinstance(arg, basestring) and isinstance(arg % 0, basestring)
+        except (TypeError, ValueError):
+            return False
+    if kind == INTEGER:
+        return isinstance(arg, (int, long)) and not isinstance(arg, bool)
+    if kind == SIZE:
+        return _is_kind(arg, NUMBER) and arg > 0
+    if kind == CURVE:
+        return isinstance(arg, (list, tuple)) and len(arg) > 0 and all(
+            isinstance(point, (list, tuple)) and len(point) == 2 and all(_is_kind(value, NUMBER) for value in point)
+            for point in arg)
+    return isinstance(arg, (int, long, float)) and not isinstance(arg, bool)
+
+
+def compile_interaction(declaration):
+    # type: (tuple) -> Interaction
+    # compile declaration (type, arguments...) with nested declarations for arguments
+    interaction_type = INTERACTION_TYPES[declaration[0]]
+    args = [compile_interaction(arg) if _is_declaration(arg) else arg for arg in declaration[1:]]
+    return interaction_type(*args)
+
+
+def _is_declaration(arg):
+    # type: (object) -> bool
+    # nested declarations start with a type name, other lists are values (e.g. acceleration curves)
+    return isinstance(arg, (list, tuple)) and len(arg) > 0 and isinstance(arg[0], basestring)
 
 
 class Command(object):
@@ -389,13 +968,31 @@ class PythonInterface:
         self.Sig = None
         self.Name = None
         self.commands = []
+        self.modes = {}  # type: Dict[str, List[tuple]]
+        self.profile = None  # type: Optional[str]
+        self.profiles = OrderedDict()  # type: Dict[Optional[str], Dict[str, List[Interaction]]]
+        self.compiled = {}  # type: Dict[str, List[Interaction]]
+        self.incomplete = set()  # type: set
+        self.mode = None  # type: Optional[str]
+        self.holds = []  # type: List[ Tuple[object, str, List[str]]]
+        self.layers = []  # type: List[str]
+        self.config_check = 0.0
         self.interactions = []
+        self.dispatch = {}  # type: Dict[object, List[int]]
+        self.labels = []  # type: List[str]
+        self.pending = []  # type: List[int]
+        self.always = []  # type: List[int]
+        self.queued = 0
+        self.throttled = 0
+        self.recorder = None  # type: Optional[Recorder]
         self.flight_loop = None
+        self.idle = 0.0
+        self.logger = XPlaneLogger()
 
     def XPluginStart(self):
 
-        logging.root.addHandler(XPlaneLogger())
-        logging.root.setLevel(logging.DEBUG)
+        logging.root.addHandler(self.logger)
+        logging.root.setLevel(LOG_LEVEL)
 
         # boilerplate
         self.Name = "PhidgetControls"
@@ -407,9 +1004,21 @@ class PythonInterface:
         logging.info("Plugin start")
 
         # set up commands for modes of interactions
-        from PhidgetControlsConfig import INTERACTIONS
-        for (k, d, i) in INTERACTIONS:
-            self.commands.append(Command(k, d, lambda sk=k, si=i: self.setInteractions(sk, si), self))
+        self.reloadConfig()
+
+        # statistics on demand and as datarefs
+        self.commands.append(Command('stats', 'Log PhidgetControls flight loop statistics', log_stats, self))
+        if PhidgetControlsStats.STATS_ENABLED:
+            publish_stats(self)
+
+        # recording of input on demand
+        self.commands.append(Command('record', 'Start/stop recording PhidgetControls input', self.toggleRecording,
+                                     self))
+        if PhidgetControlsRecorder.RECORD_INPUT:
+            self.toggleRecording()
+
+        # open phidgets in the background
+        start_connection_manager()
 
         # hook-up into X loop
         logging.debug("Registering flight loop")
@@ -419,6 +1028,7 @@ class PythonInterface:
         XPLMScheduleFlightLoop(self, self.flight_loop, FLIGHT_LOOP_TIMER, 1)
 
         # complete
+        self.logger.flush()
         return self.Name, self.Sig, self.Desc
 
     def XPluginStop(self):
@@ -427,6 +1037,13 @@ class PythonInterface:
         logging.debug("Unregistering flight loop")
         XPLMDestroyFlightLoop(self, self.flight_loop)
 
+        # write values still held back by throttling
+        release_throttled()
+        try:
+            flush_datarefs()
+        except Exception as exception:
+            logging.exception(exception)
+
         logging.debug("Close phidgets")
         close_all_phidgets()
 
@@ -434,6 +1051,14 @@ class PythonInterface:
         for command in self.commands:
             command.stop()
 
+        unpublish_stats(self)
+
+        if self.recorder:
+            self.toggleRecording()
+
+        self.logger.flush()
+        logging.root.removeHandler(self.logger)
+
     # noinspection PyMethodMayBeStatic
     def XPluginEnable(self):
         return 1
@@ -441,30 +1066,308 @@ class PythonInterface:
     def XPluginDisable(self):
         pass
 
-    def XPluginReceiveMessage(self, _in_from, _in_message, _in_param):
-        pass
+    def XPluginReceiveMessage(self, _in_from, in_message, in_param):
+
+        # user's aircraft loaded? its profile applies, datarefs not found before might resolve now
+        if in_message == XPLM_MSG_PLANE_LOADED and not in_param:
+            logging.debug("Aircraft loaded")
+            invalidate_handles()
+            for profile, mode in self.incomplete:
+                self.profiles.get(profile, {}).pop(mode, None)
+            self.incomplete.clear()
+            self.selectProfile()
 
-    def handle_loop(self, _elapsed_me, _elapsed_sim, _counter, _reference):
+    def handle_loop(self, elapsed_me, _elapsed_sim, _counter, _reference):
+
+        # measure whole loop if collecting statistics
+        if not PhidgetControlsStats.STATS_ENABLED:
+            return self.loop(elapsed_me)
+        start = default_timer()
+        timer = self.loop(elapsed_me)
+        add_loop(default_timer() - start)
+        return timer
+
+    def loop(self, elapsed):
+        # type: (float) -> float
 
         global FLIGHT_LOOP_SEQUENCE
         FLIGHT_LOOP_SEQUENCE += 1
 
-        # open all phidgets
-        ensure_phidgets_opened()
+        # configuration changed? swap in before ticking anything
+        self.config_check += elapsed
+        if self.config_check >= CONFIG_CHECK_INTERVAL:
+            self.config_check = 0.0
+            if config_changed():
+                self.reloadConfig()
+
+        # pick up input changes reported since last tick
+        changed = drain_inputs()
+        if changed and PhidgetControlsStats.STATS_ENABLED:
+            count('phidget events', sum(len(channel.changes) for channel in changed))
+        if self.recorder:
+            try:
+                self.recorder.loop(FLIGHT_LOOP_SEQUENCE, time(), changed)
+            except IOError as error:
+                logging.error("Can't write %s: %s", self.recorder.path, error)
+                self.recorder = None
+
+        # overlays held or released? layers change before interactions see input
+        if self.holds and (changed or not PhidgetControlsCache.EVENT_INPUT):
+            self.updateLayers()
+
+        # go through interactions - only those consuming changed inputs (or waiting on time, or showing outputs)
+        # if we know about changes
+        if not PhidgetControlsCache.EVENT_INPUT:
+            self.tick(range(len(self.interactions)))
+        elif changed or self.pending or self.always:
+            self.tick(self.getDispatch(changed))
+
+        # write back datarefs changed by interactions (those throttled when due), then issue (some of the) commands
+        # queued
+        try:
+            self.throttled = flush_datarefs()
+        except Exception as exception:
+            count('exceptions')
+            logging.exception(exception)
+        try:
+            self.queued = flush_commands()
+        except Exception as exception:
+            count('exceptions')
+            logging.exception(exception)
+        try:
+            flush_outputs()
+        except Exception as exception:
+            count('exceptions')
+            logging.exception(exception)
+
+        # write some of what's been logged
+        self.logger.flush(LOG_RECORDS_PER_LOOP)
+
+        # continue
+        return self.getFlightLoopTimer(elapsed, changed)
 
-        # go through interactions
+    def tick(self, indexes):
+        # type: (List[int]) -> None
+        stats = PhidgetControlsStats.STATS_ENABLED
+        pending = []
         try:
-            for interaction in self.interactions:
-                interaction.tick()
+            if not stats:
+                for index in indexes:
+                    if self.interactions[index].tick():
+                        pending.append(index)
+            else:
+                for index in indexes:
+                    start = default_timer()
+                    if self.interactions[index].tick():
+                        pending.append(index)
+                    add_tick(self.labels[index], default_timer() - start)
         except PhidgetException as phidget_exception:
+            count('exceptions')
             log_phidget_exception(phidget_exception)
         except Exception as exception:
+            count('exceptions')
             logging.exception(exception)
+        self.pending = pending
 
-        # continue
-        return FLIGHT_LOOP_TIMER
+    def getFlightLoopTimer(self, elapsed, changed):
+        # type: (float, List[InputChannel]) -> float
+
+        # can't tell activity without polling
+        if not PhidgetControlsCache.EVENT_INPUT:
+            return FLIGHT_LOOP_TIMER
+
+        # back to full rate on any input change (or while waiting on time, commands or throttled writes), slow down
+        # after a while
+        if changed or self.pending or self.queued or self.throttled:
+            self.idle = 0.0
+            return FLIGHT_LOOP_TIMER
+        self.idle += elapsed
+        return FLIGHT_LOOP_TIMER if self.idle < FLIGHT_LOOP_IDLE_AFTER else FLIGHT_LOOP_IDLE_TIMER
 
-    def setInteractions(self, mode, new_interactions):
-        # type: (str, List[Interaction]) -> None
-        logging.debug("Setting interactions for %s", mode)
+    def toggleRecording(self):
+        # type: () -> None
+        if self.recorder:
+            logging.info("Stopped recording input to %s", self.recorder.path)
+            try:
+                self.recorder.close()
+            except IOError as error:
+                logging.error("Can't write %s: %s", self.recorder.path, error)
+            self.recorder = None
+            return
+        if not PhidgetControlsCache.EVENT_INPUT:
+            logging.warning("Can't record input while polling")
+            return
+        try:
+            self.recorder = Recorder()
+        except IOError as error:
+            logging.error("Can't record input: %s", error)
+            return
+        logging.info("Recording input to %s", self.recorder.path)
+
+        # start from freshly compiled interactions and the current input like a replay does
+        self.recorder.snapshot(FLIGHT_LOOP_SEQUENCE, time(), input_channels())
+        self.compiled.clear()
+        if self.mode:
+            self.setMode(self.mode)
+
+    def reloadConfig(self):
+        # type: () -> None
+        logging.info("Loading configuration")
+        try:
+            load_config(validate_declaration)
+        except Exception as exception:
+            logging.error("Can't load configuration, keeping current: %s", exception)
+            return
+        open_phidgets(PhidgetControlsConfig.PHIDGETS.values())
+        self.profiles.clear()
+        self.incomplete.clear()
+        self.selectProfile()
+
+    def selectProfile(self):
+        # type: () -> None
+        file_name, path = [], []
+        XPLMGetNthAircraftModel(0, file_name, path)
+        profile, modes = select_profile(path[0] if path else '')
+        if profile != self.profile:
+            logging.info("Using %s", "profile for aircraft %s" % profile if profile else "default profile")
+
+        # compiled interactions of profile, most recently used last - starting over from current input
+        self.profile = profile
+        self.compiled = self.profiles.pop(profile, None) or {}
+        self.profiles[profile] = self.compiled
+        for interactions in self.compiled.values():
+            for interaction in interactions:
+                interaction.reset()
+        while len(self.profiles) > PROFILE_CACHE_SIZE:
+            self.profiles.popitem(last=False)
+        self.setModes(modes)
+
+    def setModes(self, modes):
+        # type: (List[ Tuple[str, str, List[tuple], Optional[tuple]]]) -> None
+
+        # commands for modes that are gone
+        keys = set(mode[0] for mode in modes)
+        for command in [command for command in self.commands if command.key in self.modes]:
+            if command.key not in keys:
+                command.stop()
+                self.commands.remove(command)
+
+        # commands for new modes
+        for (k, d, i, _) in modes:
+            if k not in self.modes:
+                self.commands.append(Command(k, d, lambda sk=k: self.setMode(sk), self))
+
+        # overlays by the input holding them
+        self.holds = [(get_input(PhidgetControlsConfig.PHIDGETS[overlay[0]]), k, overlay[1])
+                      for (k, _, _, overlay) in modes if overlay]
+
+        # current mode (keeping phidgets open) if still there
+        self.modes = dict((k, i) for (k, _, i, _) in modes)
+        if self.mode in self.modes:
+            self.setMode(self.mode)
+        elif self.mode:
+            self.mode = None
+            self.setLayers([])
+
+    def setMode(self, mode):
+        # type: (str) -> None
+        self.mode = mode
+        self.setLayers(self.getLayers())
+        if self.recorder:
+            self.recorder.mode(FLIGHT_LOOP_SEQUENCE, time(), mode)
+
+    def getLayers(self):
+        # type: () -> List[str]
+        # selected mode with overlays held on top, in order of declaration
+        layers = [self.mode] if self.mode else []
+        for state_producer, mode, over in self.holds:
+            if not self.mode or mode == self.mode or (over and self.mode not in over):
+                continue
+            try:
+                if state_producer.getState():
+                    layers.append(mode)
+            except PhidgetException as phidget_exception:
+                log_phidget_exception(phidget_exception)
+        return layers
+
+    def updateLayers(self):
+        # type: () -> None
+        layers = self.getLayers()
+        if layers != self.layers:
+            self.setLayers(layers)
+
+    def setLayers(self, layers):
+        # type: (List[str]) -> None
+        # compile on first activation
+        compiled = []
+        for mode in layers:
+            interactions = self.compiled.get(mode)
+            if interactions is None:
+                interactions = self.compiled[mode] = self.compileMode(mode)
+            compiled.append(interactions)
+        self.layers = layers
+        self.setInteractions(layers, compiled)
+
+    def compileMode(self, mode):
+        # type: (str) -> List[Interaction]
+        logging.debug("Compiling interactions for %s", mode)
+        interactions = []
+        for declaration in self.modes[mode]:
+            try:
+                interactions.append(compile_interaction(declaration))
+            except (LookupError, ValueError, TypeError) as error:
+                # e.g. datarefs only available in some aircraft - compiled again after next aircraft load
+                logging.warning("Skipping %s in %s: %s", declaration[0], mode, error)
+                self.incomplete.add((self.profile, mode))
+        return interactions
+
+    def setInteractions(self, layers, compiled):
+        # type: (List[str], List[List[Interaction]]) -> None
+        global ACTIVE_MODE
+
+        logging.debug("Setting interactions for %s", ' + '.join(layers) or 'none')
+
+        # the top-most layer using a phidget owns it
+        owners = {}
+        for layer, interactions in enumerate(compiled):
+            for interaction in interactions:
+                for key in interaction.inputs + interaction.outputs:
+                    owners[key] = layer
+
+        # only interactions owning all their phidgets are live - others don't see input until owning them again
+        new_interactions = []
+        labels = []
+        for layer, interactions in enumerate(compiled):
+            for index, interaction in enumerate(interactions):
+                if all(owners[key] == layer for key in interaction.inputs + interaction.outputs):
+                    new_interactions.append(interaction)
+                    labels.append('%s#%i %s' % (layers[layer], index, interaction.__class__.__name__))
+
+        # interactions becoming live start over from current input rather than jump to it
+        live = set(self.interactions)
+        for interaction in new_interactions:
+            if interaction not in live:
+                interaction.reset()
+
+        # index interactions (in order) by the inputs they consume, including nested conditions
+        dispatch = {}
+        for index, interaction in enumerate(new_interactions):
+            for key in set(interaction.inputs):
+                dispatch.setdefault(key, []).append(index)
+
+        ACTIVE_MODE = layers[-1] if layers else 'none'
         self.interactions = new_interactions
+        self.dispatch = dispatch
+        self.pending = []
+        self.always = [index for index, interaction in enumerate(new_interactions) if interaction.outputs]
+        self.labels = labels
+
+    def getDispatch(self, changed):
+        # type: (List[InputChannel]) -> List[int]
+        if len(changed) == 1 and not self.pending and not self.always:
+            return self.dispatch.get(changed[0].key, ())
+        indexes = set(self.pending)
+        indexes.update(self.always)
+        for channel in changed:
+            indexes.update(self.dispatch.get(channel.key, ()))
+        return sorted(indexes)
@@ -0,0 +1,245 @@
+"""
+    Phidget Controls Benchmark - ns/op of producers, interaction ticks and whole flight loops against the
+    simulator's stand-ins for XPLM and Phidget22, idle and spinning, for 1 to 500 interactions
+
+    Usage:
+      python PhidgetControlsBenchmark.py [--quick] [--output FILE] [--baseline FILE] [--save-baseline]
+                                         [--tolerance 1.25]
+
+    Results are written as JSON {"results": {name: ns/op}, ...} and compared against the baseline (by default
+    PhidgetControlsBenchmark.baseline.json if present) - exits with 1 if any result is slower than baseline by
+    more than the tolerance, or a flight loop takes longer than FLIGHT_LOOP_BUDGET
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+from timeit import default_timer
+from typing import Callable, Dict, List
+
+import PhidgetControlsSimulator as Simulator
+
+# Configuration: baseline file, minimum seconds per measurement, measurements (best counts), interactions in
+# flight loop benchmarks, slowdown against baseline considered a regression, and seconds per flight loop
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PhidgetControlsBenchmark.baseline.json')
+MIN_TIME = 0.2
+REPEAT = 5
+INTERACTION_COUNTS = (1, 10, 100, 500)
+TOLERANCE = 1.25
+FLIGHT_LOOP_BUDGET = 0.01
+
+
+class SteadyPositionProducer(object):
+    def __init__(self, position):
+        self.position = position
+
+    def getPosition(self):
+        return self.position
+
+
+class SpinningPositionProducer(SteadyPositionProducer):
+    def getPosition(self):
+        self.position += 3
+        return self.position
+
+
+def measure(operation):
+    # type: (Callable[[], object]) -> float
+    # best of REPEAT runs in ns per operation, calibrating runs to take at least MIN_TIME
+    number = 1
+    while True:
+        elapsed = _run(operation, number)
+        if elapsed >= MIN_TIME:
+            break
+        number *= 10 if elapsed < MIN_TIME / 10 else 2
+    best = min([elapsed] + [_run(operation, number) for _ in range(REPEAT - 1)])
+    return best * 1e9 / number
+
+
+def _run(operation, number):
+    # type: (Callable[[], object], int) -> float
+    gc.disable()
+    try:
+        start = default_timer()
+        for _ in xrange(number):
+            operation()
+        return default_timer() - start
+    finally:
+        gc.enable()
+
+
+def benchmark_producers(results):
+    # type: (Dict[str, float]) -> None
+    from PI_PhidgetControls import NotchedPositionProducer, DeltaProducer, RelativePositionProducer, \
+        NotchedDeltaProducer
+
+    for workload, producer_type in (('idle', SteadyPositionProducer), ('spin', SpinningPositionProducer)):
+        results['NotchedPositionProducer.getPosition/%s' % workload] = measure(
+            NotchedPositionProducer(producer_type(100), 10).getPosition)
+        results['DeltaProducer.getDelta/%s' % workload] = measure(
+            DeltaProducer(NotchedPositionProducer(producer_type(100), 10)).getDelta)
+        results['DeltaProducer.getDelta/relative/%s' % workload] = measure(
+            DeltaProducer(NotchedPositionProducer(RelativePositionProducer(producer_type(100)), 10)).getDelta)
+        results['NotchedDeltaProducer.getDelta/%s' % workload] = measure(
+            NotchedDeltaProducer(producer_type(100), 10).getDelta)
+        results['NotchedDeltaProducer.getDelta/relative/%s' % workload] = measure(
+            NotchedDeltaProducer(producer_type(100), 10, relative=True).getDelta)
+
+
+def benchmark_ticks(results):
+    # type: (Dict[str, float]) -> None
+    import PhidgetControlsConfig
+    from PhidgetControlsSimulator import Encoder, DigitalInput
+    from PhidgetControlsInput import device
+    from PI_PhidgetControls import compile_interaction
+
+    PhidgetControlsConfig.PHIDGETS = {
+        'E1': device(Encoder, 1), 'D1': device(DigitalInput, 1), 'D2': device(DigitalInput, 2)}
+    declarations = {
+        'Rotate.tick': ('Rotate', 'E1', 2, 'sim/benchmark/rotate', 0.0, 360.0, 1.0),
+        'SetDigit.tick': ('SetDigit', 'E1', 'sim/benchmark/digit', 2),
+        'If.tick/depth1': ('If', 'D1', ('Rotate', 'E1', 2, 'sim/benchmark/rotate', 0.0, 360.0, 1.0)),
+        'Unless.tick/depth1': ('Unless', 'D2', ('Rotate', 'E1', 2, 'sim/benchmark/rotate', 0.0, 360.0, 1.0)),
+        'If.tick/depth4': ('If', 'D1', ('Unless', 'D2', ('If', 'D1', ('Unless', 'D2', (
+            'Rotate', 'E1', 2, 'sim/benchmark/rotate', 0.0, 360.0, 1.0)))))}
+
+    for name, declaration in sorted(declarations.items()):
+        interaction = compile_interaction(declaration)
+        channels = _channels()
+        channels['D1'].state = True
+        channels['D2'].state = False
+        encoder = channels['E1']
+
+        def spin(tick=interaction.tick):
+            encoder.position += 3
+            encoder.sequence += 1
+            tick()
+
+        results['%s/idle' % name] = measure(interaction.tick)
+        results['%s/spin' % name] = measure(spin)
+
+
+def benchmark_flight_loops(results, xplane, counts):
+    # type: (Dict[str, float], Simulator.SimulatedXPlane, List[int]) -> None
+    import PhidgetControlsConfig
+
+    directory = tempfile.mkdtemp()
+    PhidgetControlsConfig.CONFIG_FILE = os.path.join(directory, 'PhidgetControlsConfig.json')
+    PhidgetControlsConfig.CACHE_FILE = PhidgetControlsConfig.CONFIG_FILE + '.cache'
+
+    _write_config(PhidgetControlsConfig.CONFIG_FILE, 1)
+    simulation = Simulator.start(xplane)
+    try:
+        for count in counts:
+            _write_config(PhidgetControlsConfig.CONFIG_FILE, count)
+            simulation.plugin.reloadConfig()
+            simulation.step('mode BENCH')
+            encoders = [Simulator.get_virtual_phidget('E%i' % number) for number in range(1, min(count, 4) + 1)]
+
+            def spin():
+                for encoder in encoders:
+                    encoder.turn(3)
+                xplane.runFlightLoops()
+
+            results['handle_loop/idle/%i' % count] = measure(xplane.runFlightLoops)
+            results['handle_loop/spin/%i' % count] = measure(spin)
+    finally:
+        simulation.plugin.XPluginStop()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def _channels():
+    # type: () -> Dict[str, object]
+    import PhidgetControlsCache
+    from PhidgetControlsConfig import PHIDGETS
+    return dict((name, PhidgetControlsCache.get_input(phidget)) for name, phidget in PHIDGETS.items())
+
+
+def _write_config(path, count):
+    # type: (str, int) -> None
+    # count interactions on 4 encoders, a mix of rotations, values, digits and conditions
+    interactions = []
+    for index in range(count):
+        encoder = 'E%i' % (index % 4 + 1)
+        ref = 'sim/benchmark/%i' % index
+        interactions.append([
+            ['Tune', encoder, ref, 0, 1000, 1],
+            ['SetValue', encoder, ref, 100.0, 0, 56000],
+            ['SetDigit', encoder, ref, 2],
+            ['If', 'D1', ['SetHeading', encoder, ref]],
+            ['Unless', 'D1', ['SetBearing', encoder, ref]]][index % 5])
+    config = {
+        'phidgets': dict([('E%i' % number, ['Encoder', number]) for number in range(1, 5)] + [
+            ('D1', ['DigitalInput', 1])]),
+        'modes': [{'mode': 'BENCH', 'description': 'Benchmark', 'interactions': interactions}]}
+    with open(path, 'w') as config_file:
+        json.dump(config, config_file)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # type: (Dict[str, float], Dict[str, float], float) -> List[str]
+    # names of results regressed against baseline or over the flight loop budget
+    failures = []
+    for name in sorted(results):
+        line = '%-45s %12.0f ns/op' % (name, results[name])
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            line += ' %12.0f baseline %5.2fx' % (baseline[name], ratio)
+            if ratio > tolerance:
+                line += ' REGRESSION'
+                failures.append(name)
+        if name.startswith('handle_loop/') and results[name] > FLIGHT_LOOP_BUDGET * 1e9:
+            line += ' OVER BUDGET'
+            failures.append(name)
+        print(line)
+    return failures
+
+
+def main(argv):
+    global MIN_TIME
+    parser = argparse.ArgumentParser(description='Benchmark PhidgetControls producers, ticks and flight loops')
+    parser.add_argument('--quick', action='store_true', help='shorter measurements, up to 100 interactions')
+    parser.add_argument('--output', help='write results as JSON to file')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='compare against results in JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='write results to baseline file')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='slowdown against baseline to fail on')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        MIN_TIME /= 10
+    counts = [count for count in INTERACTION_COUNTS if not args.quick or count <= 100]
+
+    # stand-ins before anything imports XPLM or Phidget22
+    xplane = Simulator.SimulatedXPlane()
+    Simulator.install(xplane)
+    import logging
+    logging.root.addHandler(logging.NullHandler())
+
+    results = {}
+    benchmark_producers(results)
+    benchmark_ticks(results)
+    benchmark_flight_loops(results, xplane, counts)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    failures = compare(results, baseline, args.tolerance)
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(), 'results': results}
+    paths = [args.output, args.baseline if args.save_baseline else None]
+    for path in paths:
+        if path:
+            with open(path, 'w') as output_file:
+                json.dump(report, output_file, indent=2, sort_keys=True)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
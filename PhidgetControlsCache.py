@@ -1,61 +1,328 @@
 import logging
+import threading
 import time
-from typing import Dict
+from typing import Dict, List, Union, Optional
 
 from Phidget22.ErrorCode import ErrorCode
 from Phidget22.Phidget import Phidget
 from Phidget22.PhidgetException import PhidgetException
+from PhidgetControlsInput import InputAccumulator, InputChannel, Device, device_name
+from PhidgetControlsWorker import RingInputAccumulator, WorkerSupervisor, WORKER_TYPES
+import PhidgetControlsStats
+from PhidgetControlsStats import CountingPhidget, count
 
 IGNORE_PHIDGET_ERROR = [ErrorCode.EPHIDGET_NOTATTACHED, ErrorCode.EPHIDGET_UNKNOWNVAL]  # type: [int]
 
-_phidgets = {}  # type: Dict[ (type[Phidget], int), Phidget]
-_last_ensure_open = 0
+# Configuration: read inputs via phidget change handlers (True) or by polling each tick (False)
+EVENT_INPUT = True
 
+# Configuration: writes per second to an output phidget at most, values set in between are coalesced
+OUTPUT_RATE = 20.0
 
-def get_phidget(phidget_type, phidget_id):
-    # type: ( type[Phidget], int) -> Phidget
-    key = (phidget_type, phidget_id)
-    if key in _phidgets:
-        return _phidgets[key]
+# Configuration: leave phidgets to a helper process streaming their input (see PhidgetControlsWorker.py)
+WORKER_INPUT = False
 
-    phidget = phidget_type()  # type: Phidget
-    phidget.setDeviceSerialNumber(phidget_id)
+# Configuration: seconds between attempts to open (or re-open a detached) phidget, doubling up to max
+RECONNECT_BACKOFF_MIN = 1.0
+RECONNECT_BACKOFF_MAX = 32.0
+
+_phidgets = {}  # type: Dict[Device, Phidget]
+_attached = {}  # type: Dict[Device, bool]
+_attached_lock = threading.Lock()
+_connection_manager = None  # type: Optional[ConnectionManager]
+_inputs = InputAccumulator()
+_worker_inputs = None  # type: Optional[RingInputAccumulator]
+_worker_supervisor = None  # type: Optional[WorkerSupervisor]
+_outputs = {}  # type: Dict[Device, OutputPhidget]
+
+
+def get_phidget(key, wakeup=True):
+    # type: (Device, bool) -> Phidget
+    phidget = _phidgets.get(key)
+    if phidget is not None:
+        return phidget
+
+    phidget = key.type()  # type: Phidget
+    phidget.setDeviceSerialNumber(key.serial)
+    if key.hub_port >= 0:
+        phidget.setHubPort(key.hub_port)
+        phidget.setIsHubPortDevice(key.hub_port_device)
+    if key.channel >= 0:
+        phidget.setChannel(key.channel)
+    phidget.setOnAttachHandler(lambda _ch: _set_attached(key, True))
+    phidget.setOnDetachHandler(lambda _ch: _set_attached(key, False))
+    if EVENT_INPUT:
+        _set_input_handlers(phidget, key)
     _phidgets[key] = phidget
 
-    log_phidget(phidget, 'Instantiated')
+    log_phidget(key, 'Instantiated')
+
+    # let connection manager open it
+    if _connection_manager and wakeup:
+        _connection_manager.wakeup.set()
 
     return phidget
 
 
+def get_input(key, wakeup=True):
+    # type: (Device, bool) -> Union[Phidget, InputChannel]
+    global _worker_inputs
+    if _is_worker_input(key):
+        if not _worker_inputs:
+            _worker_inputs = RingInputAccumulator(_set_attached)
+        channel = _worker_inputs.channel(key)
+        # let worker supervisor (re-)start worker for it
+        if _worker_supervisor and wakeup:
+            _worker_supervisor.wakeup.set()
+        return channel
+
+    phidget = get_phidget(key, wakeup)
+    if not EVENT_INPUT:
+        return CountingPhidget(phidget) if PhidgetControlsStats.STATS_ENABLED else phidget
+    return _inputs.channel(key)
+
+
+def get_output(key):
+    # type: (Device) -> OutputPhidget
+    output = _outputs.get(key)
+    if output is None:
+        output = _outputs[key] = OutputPhidget(key, get_phidget(key))
+    return output
+
+
+def open_phidgets(keys):
+    # type: (List[Device]) -> None
+    # instantiate all configured phidgets at once - the connection manager (or worker) opens them in one pass,
+    # attaching asynchronously in parallel rather than one by one as modes get compiled
+    for key in keys:
+        if _is_worker_input(key):
+            get_input(key, wakeup=False)
+        else:
+            get_phidget(key, wakeup=False)
+    if _connection_manager:
+        _connection_manager.wakeup.set()
+    if _worker_supervisor:
+        _worker_supervisor.wakeup.set()
+
+
+def _is_worker_input(key):
+    # type: (Device) -> bool
+    return WORKER_INPUT and key.type.__name__ in WORKER_TYPES
+
+
+def flush_outputs():
+    # type: () -> None
+    now = time.time()
+    for output in _outputs.itervalues():
+        if output.desired:
+            output.flush(now)
+
+
+def input_channels():
+    # type: () -> List[InputChannel]
+    # channels of inputs as of the last drain
+    return (_worker_inputs or _inputs).channels.values()
+
+
+def drain_inputs():
+    # type: () -> List[InputChannel]
+    return _worker_inputs.drain() if _worker_inputs else _inputs.drain()
+
+
+def _set_input_handlers(phidget, key):
+    # type: (Phidget, Device) -> None
+    if hasattr(phidget, 'setOnPositionChangeHandler'):
+        phidget.setOnPositionChangeHandler(
+            lambda _ch, position_change, _time_change, _index_triggered: _inputs.positionChanged(
+                key, position_change))
+    if hasattr(phidget, 'setOnStateChangeHandler'):
+        phidget.setOnStateChangeHandler(lambda _ch, state: _inputs.stateChanged(key, state))
+
+
 def close_all_phidgets():
     # type: () -> None
+    global _worker_inputs, _attached
+    stop_connection_manager()
+    if _worker_inputs:
+        _worker_inputs.close()
+        _worker_inputs = None
     for key, phidget in _phidgets.iteritems():
         try:
-            log_phidget(phidget, 'Closing')
+            log_phidget(key, 'Closing')
             phidget.close()
         except PhidgetException:
             pass
     _phidgets.clear()
+    with _attached_lock:
+        _attached = {}
+    _outputs.clear()
 
 
-def ensure_phidgets_opened():
+def attached_phidgets():
+    # type: () -> Dict[Device, bool]
+    # snapshot maintained by attach/detach handlers - read-only, no device I/O
+    return _attached
+
+
+def start_connection_manager():
     # type: () -> None
+    global _connection_manager, _worker_inputs, _worker_supervisor
+    if _connection_manager:
+        return
+    _connection_manager = ConnectionManager()
+    _connection_manager.start()
+    # inputs from worker (outputs stay with connection manager)
+    if WORKER_INPUT:
+        if not _worker_inputs:
+            _worker_inputs = RingInputAccumulator(_set_attached)
+        _worker_supervisor = WorkerSupervisor(_worker_inputs)
+        _worker_supervisor.start()
 
-    # wait for at least 1s between attempts
-    if time.time() - _last_ensure_open < 1:
+
+def stop_connection_manager():
+    # type: () -> None
+    global _connection_manager, _worker_supervisor
+    if _worker_supervisor:
+        _worker_supervisor.stop()
+        _worker_supervisor = None
+    if not _connection_manager:
         return
-    _open_retry_timer = time.time()
+    _connection_manager.stop()
+    _connection_manager = None
+
+
+def _set_attached(key, attached):
+    # type: (Device, bool) -> None
+    global _attached
+    with _attached_lock:
+        # publish a new snapshot rather than changing the one readers might hold
+        snapshot = dict(_attached)
+        snapshot[key] = attached
+        _attached = snapshot
+    if _connection_manager:
+        _connection_manager.wakeup.set()
+
+
+class ConnectionManager(threading.Thread):
+    """
+        Opens phidgets off the sim thread - retrying failed opens, and re-opening phidgets that stay
+        detached, with exponential backoff
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='PhidgetControlsConnectionManager')
+        self.daemon = True
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.opened = {}  # type: Dict[Device, bool]
+        self.next_attempt = {}  # type: Dict[Device, float]
+        self.backoff = {}  # type: Dict[Device, float]
+
+    def stop(self):
+        # type: () -> None
+        self.stopping = True
+        self.wakeup.set()
+        self.join()
+
+    def run(self):
+        # type: () -> None
+        while not self.stopping:
+            self.wakeup.clear()
+            now = time.time()
+            timeout = RECONNECT_BACKOFF_MAX
+            for key, phidget in list(_phidgets.items()):
+                timeout = min(timeout, self.connect(key, phidget, now))
+            self.wakeup.wait(max(0.0, timeout))
+
+    def connect(self, key, phidget, now):
+        # type: (Device, Phidget, float) -> float
+
+        # attached? nothing to do until detached
+        if attached_phidgets().get(key):
+            self.backoff.pop(key, None)
+            self.next_attempt.pop(key, None)
+            return RECONNECT_BACKOFF_MAX
+
+        # just detached? give it time to re-attach by itself
+        next_attempt = self.next_attempt.get(key)
+        if next_attempt is None and self.opened.get(key):
+            next_attempt = self.next_attempt[key] = now + RECONNECT_BACKOFF_MIN
+
+        # not yet time for next attempt?
+        if next_attempt is not None and now < next_attempt:
+            return next_attempt - now
 
-    for phidget in _phidgets.values():
-        # is the phidget attached?
-        if not phidget.getAttached():
+        backoff = self.backoff.get(key, RECONNECT_BACKOFF_MIN)
+        self.backoff[key] = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+        self.next_attempt[key] = now + backoff
 
-            # try to open/attach
-            try:
-                log_phidget(phidget, "Opening")
-                phidget.open()
-            except PhidgetException, e:
-                log_phidget_exception(e)
+        try:
+            # opened but still not attached after backoff? start fresh
+            if self.opened.get(key):
+                log_phidget(key, "Re-opening")
+                self.opened[key] = False
+                count('phidget calls')
+                phidget.close()
+            else:
+                log_phidget(key, "Opening")
+
+            # open/attach asynchronously, attach handler will follow
+            count('phidget calls')
+            phidget.open()
+            self.opened[key] = True
+
+        except PhidgetException as e:
+            log_phidget_exception(e)
+
+        return backoff
+
+
+class OutputPhidget(object):
+    """
+        Shadow state of an output phidget - writes (setter, arguments) -> value only if different from what's
+        been written, at most OUTPUT_RATE times per second with values set in between coalesced
+    """
+
+    def __init__(self, key, phidget):
+        # type: (Device, Phidget) -> None
+        self.key = key
+        self.phidget = phidget
+        self.desired = {}  # type: Dict[ (str, tuple), object]
+        self.shadow = {}  # type: Dict[ (str, tuple), object]
+        self.attached = False
+        self.written = 0.0
+
+    def set(self, setter, arguments, value):
+        # type: (str, tuple, object) -> None
+        self.desired[(setter, arguments)] = value
+
+    def flush(self, now):
+        # type: (float) -> None
+
+        # (re-)attached phidgets start fresh
+        attached = attached_phidgets().get(self.key, False)
+        if attached != self.attached:
+            self.attached = attached
+            self.shadow.clear()
+        if not attached or now - self.written < 1.0 / OUTPUT_RATE:
+            return
+
+        changes = [(address, value) for address, value in self.desired.iteritems()
+                   if self.shadow.get(address) != value]
+        if not changes:
+            return
+        self.written = now
+        try:
+            for (setter, arguments), value in sorted(changes):
+                count('phidget calls')
+                getattr(self.phidget, setter)(*(arguments + (value,)))
+                self.shadow[(setter, arguments)] = value
+            # e.g. LCD showing text written
+            if hasattr(self.phidget, 'flush'):
+                count('phidget calls')
+                self.phidget.flush()
+        except PhidgetException as e:
+            log_phidget_exception(e)
 
 
 def log_phidget_exception(e):
@@ -65,7 +332,6 @@ def log_phidget_exception(e):
     logging.info('%s (%i)', e.description, e.code)
 
 
-def log_phidget(phidget, message):
-    # type: (Phidget, str) -> None
-    class_name = phidget.__class__.__name__
-    logging.debug('Phidget %s#%i: %s', class_name, phidget.getDeviceSerialNumber(),  message)
+def log_phidget(key, message):
+    # type: (Device, str) -> None
+    logging.debug('Phidget %s: %s', device_name(key), message)
@@ -1,73 +1,214 @@
-from typing import Dict, Tuple, List
+"""
+    Loads phidgets and interactions from PhidgetControlsConfig.json
+
+    {
+      "phidgets": {"E1": ["Encoder", 82081], "E9": ["Encoder", 620001, 2], "D9": ["DigitalInput", 82081, -1, 5], ...},
+      "modes": [
+        {"mode": "COM1", "description": "...", "interactions": [
+          ["Tune", "E1", "sim/cockpit2/radios/actuators/com1_standby_frequency_Mhz", 118, 137, 1],
+          ["If", "D1", ["SetValue", "E1", "sim/cockpit/autopilot/altitude", 1000.0, 0, 56000]], ...]},
+        ...],
+      "aircraft": [
+        {"match": "*/Cessna 172SP/*", "modes": [
+          {"mode": "NAV1", "description": "...", "interactions": [...]}, ...]},
+        ...]
+    }
+
+    A mode with "hold": phidget is an overlay - stacked on top of the selected mode while the phidget's input is
+    held (only over the modes listed in "over", if given), e.g.
+        {"mode": "ADF_FINE", "description": "...", "hold": "D1", "over": ["ADF"], "interactions": [...]}
+    The top-most layer using a phidget owns it - interactions of layers below using it are suspended meanwhile.
+
+    Aircraft profiles are matched in order against the path and file name of the user's aircraft (case-insensitive
+    shell-style patterns) - the first matching profile's modes replace modes of the same name and add to the others.
+
+    Rotate, Tune, SetHeading, SetBearing and SetValue take an optional acceleration curve of [velocity, factor]
+    points (velocity in encoder positions per second), e.g.
+      ["SetHeading", "E1", "sim/cockpit/autopilot/heading_mag", [[50, 1], [200, 5], [400, 10]]]
+
+    ShowMode, ShowValue and Light show the active mode and dataref values on LCD and DigitalOutput phidgets, e.g.
+      ["ShowValue", "L1", "sim/cockpit/autopilot/altitude", "ALT %5d", 1]
+
+    Phidgets are declared as [type, serial, hub port, channel, hub port device] with hub port and channel -1 for any
+    (the default), and hub port device true for a VINT hub port used directly (e.g. as digital input).
+
+    Rotate, Tune, SetHeading, SetBearing, SetDigit and SetValue take an optional maximum of dataref writes per
+    second - values in between are held back and the last one written once due, e.g.
+      ["SetValue", "E1", "sim/cockpit/autopilot/altitude", 100.0, 0, 56000, null, 10]
+
+    Datarefs can address elements of array datarefs as path[index] or path[start:stop] - a range reads as its first
+    element and is written to all elements, e.g. ["SetValue", "E1", "sim/flightmodel/engine/ENGN_thro[0:4]", 0.05, 0, 1]
+
+    Interactions are declared as [type, arguments...] and only compiled when their mode is first activated.
+    The validated configuration is cached next to the file, keyed by its modification time and hash.
+"""
+import fnmatch
+import json
+import logging
+import os
+import pickle
+from hashlib import sha1
+from typing import Dict, Tuple, List, Callable, Optional
 from Phidget22 import Phidget
 from Phidget22.Devices.Encoder import Encoder
 from Phidget22.Devices.DigitalInput import DigitalInput
-from PI_PhidgetControls import Interaction, Tune, Click, SetBearing, SetDigit, SetHeading, \
-    SetValue, UpDown, If, Unless
-
-# Configuration: phidgets and interactions
-PHIDGETS = {
-    'E1': (Encoder, 82081),
-    'E2': (Encoder, 82141),
-    'D1': (DigitalInput, 82081),
-    'D2': (DigitalInput, 82141)
-}  # type: Dict[str, (type[Phidget], int)]
-
-INTERACTIONS = [
-    ('COM1', 'COM1 Frequency Mhz (flip standby) and Khz (fine up)', [
-        Tune('E1', 'sim/cockpit2/radios/actuators/com1_standby_frequency_Mhz', 118, 137, 1),
-        Tune('E2', 'sim/cockpit2/radios/actuators/com1_standby_frequency_khz', 0, 1000, 10),
-        Click('D1', 'sim/radios/com1_standy_flip'),
-        Click('D2', 'sim/radios/stby_com1_fine_up_833')]),
-    ('NAV1', 'NAV1 Frequency Mhz (flip standby) and Khz', [
-        Tune('E1', 'sim/cockpit2/radios/actuators/nav1_standby_frequency_Mhz', 108, 117, 1),
-        Tune('E2', 'sim/cockpit2/radios/actuators/nav1_standby_frequency_khz', 0, 95, 10),
-        Click('D1', 'sim/radios/nav1_standy_flip')]),
-    ('NAV2', 'NAV2 Frequency Mhz (flip standby) and Khz', [
-        Tune('E1', 'sim/cockpit2/radios/actuators/nav2_standby_frequency_Mhz', 108, 117, 1),
-        Tune('E2', 'sim/cockpit2/radios/actuators/nav2_standby_frequency_khz', 0, 95, 10),
-        Click('D1', 'sim/radios/nav2_standy_flip')]),
-    ('OBS', 'OBS Degree Nav1 and Nav2', [
-        SetBearing('E1', 'sim/cockpit/radios/nav1_obs_degm'),
-        SetBearing('E2', 'sim/cockpit/radios/nav2_obs_degm')]),
-    ('ADF', 'ADF Frequency 100 (flip standby) and 10', [
-        Unless('D1', SetValue('E1', 'sim/cockpit2/radios/actuators/adf1_standby_frequency_hz', 100, 0, 9999)),
-        If('D1', SetValue('E1', 'sim/cockpit2/radios/actuators/adf1_standby_frequency_hz', 1000, 0, 9999)),
-        Unless('D2', SetValue('E2', 'sim/cockpit2/radios/actuators/adf1_standby_frequency_hz', 1, 0, 9999)),
-        If('D2', SetValue('E2', 'sim/cockpit2/radios/actuators/adf1_standby_frequency_hz', 10, 0, 9999)),
-        Click('D1', 'sim/radios/adf1_standy_flip')]),
-    ['ADFCARD', 'ADF Card', (
-        SetBearing('E1', 'sim/cockpit/radios/adf1_cardinal_dir'))],
-    ['QNH', 'Barometer', (
-        SetValue('E1', 'sim/cockpit/misc/barometer_setting', 0.01, 27.90, 31.50))],
-    ('TRANSPONDER', 'Transponder', [
-        Unless('D1', SetDigit('E1', 'sim/cockpit2/radios/actuators/transponder_code', 4)),
-        If('D1', SetDigit('E1', 'sim/cockpit2/radios/actuators/transponder_code', 3)),
-        Unless('D2', SetDigit('E2', 'sim/cockpit2/radios/actuators/transponder_code', 2)),
-        If('D2', SetDigit('E2', 'sim/cockpit2/radios/actuators/transponder_code', 1))]),
-    ('HDG', 'Heading Degree (AP follow) and Drift Degree (AP hold)', [
-        SetHeading('E1', 'sim/cockpit/autopilot/heading_mag'),
-        SetHeading('E2', 'sim/cockpit/gyros/dg_drift_vac_deg'),
-        Click('D1', 'sim/autopilot/heading'),
-        Click('D1', 'sim/autopilot/heading_hold')]),
-    ('APLATERAL', 'Autopilot Heading (follow) and Nav1 (track)', [
-        SetHeading('E1', 'sim/cockpit/autopilot/heading_mag'),
-        SetHeading('E2', 'sim/cockpit/radios/nav1_obs_degm'),  # sim/cockpit/gyros/dg_drift_vac_deg
-        Click('D1', 'sim/autopilot/heading'),  # sim/autopilot/heading_hold
-        Click('D2', 'sim/autopilot/NAV')]),
-    ('APALTITUDE', 'Autopilot Altitude 1000 (follow) and 100 (sync)', [
-        SetValue('E1', 'sim/cockpit/autopilot/altitude', 1000.0, 0, 56000),
-        SetValue('E2', 'sim/cockpit/autopilot/altitude', 100.0, 0, 56000),
-        Click('D1', 'sim/autopilot/altitude_hold'),
-        Click('D2', 'sim/autopilot/altitude_sync')]),
-    ('APVERTICAL', 'Autopilot Vertical Velocity 1000 (follow) and 100 (hold current)', [
-        SetValue('E1', 'sim/cockpit/autopilot/vertical_velocity', 1000.0, -2500, 2500),
-        SetValue('E2', 'sim/cockpit/autopilot/vertical_velocity', 100.0, -2500, 2500),
-        Click('D1', 'sim/autopilot/vertical_speed_pre_sel'),
-        Click('D2', 'sim/autopilot/vertical_speed')]),
-    ('GARMIN530', 'Garmin 530', [
-        Unless('D2', UpDown('E2', 'sim/GPS/g430n1_chapter_up', 'sim/GPS/g430n1_chapter_dn')),
-        If('D2', UpDown('E2', 'sim/GPS/g430n1_page_up', 'sim/GPS/g430n1_page_dn')),
-        Click('D1', 'sim/GPS/g430n1_chapter_up'),
-        Click('D2', 'sim/GPS/g430n1_chapter_dn')])
-]  # type: List[ Tuple[str, str, List[Interaction]]]
+from Phidget22.Devices.DigitalOutput import DigitalOutput
+from Phidget22.Devices.LCD import LCD
+from PhidgetControlsInput import Device, device
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PhidgetControlsConfig.json')
+CACHE_FILE = CONFIG_FILE + '.cache'
+CACHE_VERSION = 6
+
+# phidget types available to configuration by name
+PHIDGET_TYPES = dict((phidget_type.__name__, phidget_type) for phidget_type in [
+    Encoder, DigitalInput, DigitalOutput, LCD])  # type: Dict[str, type[Phidget]]
+
+# Configuration: phidgets and interactions - as last loaded
+PHIDGETS = {}  # type: Dict[str, Device]
+INTERACTIONS = []  # type: List[ Tuple[str, str, List[tuple], Optional[ Tuple[str, List[str]]]]]
+PROFILES = []  # type: List[ Tuple[str, List[tuple]]]
+
+_loaded = None  # type: Optional[ (float, int)]
+
+
+def load_config(validate):
+    # type: (Callable[[list, Dict[str, tuple]], tuple]) -> None
+    # load configuration - validate(declaration, phidgets) checks and returns a declaration ready to compile
+    global PHIDGETS, INTERACTIONS, PROFILES, _loaded
+
+    # unchanged since cached? (same modification time and size, or same content)
+    stat = os.stat(CONFIG_FILE)
+    _loaded = (stat.st_mtime, stat.st_size)
+    cached = _read_cache()
+    if not cached or (cached['mtime'], cached['size']) != (stat.st_mtime, stat.st_size):
+        with open(CONFIG_FILE, 'rb') as config_file:
+            data = config_file.read()
+        digest = sha1(data).hexdigest()
+        if not cached or cached['digest'] != digest:
+            logging.debug("Validating %s", CONFIG_FILE)
+            phidgets, interactions, profiles = _validate(_native(json.loads(data.decode('utf-8'))), validate)
+            cached = {'version': CACHE_VERSION, 'digest': digest, 'phidgets': phidgets,
+                      'interactions': interactions, 'profiles': profiles}
+        cached.update(mtime=stat.st_mtime, size=stat.st_size)
+        _write_cache(cached)
+
+    # swap in
+    PHIDGETS = dict((name, device(PHIDGET_TYPES[phidget[0]], *phidget[1:]))
+                    for name, phidget in cached['phidgets'].items())
+    INTERACTIONS = cached['interactions']
+    PROFILES = cached['profiles']
+
+
+def select_profile(aircraft):
+    # type: (str) -> (Optional[str], List[tuple])
+    # profile matching aircraft's path (if any) and its modes on top of the others
+    path = aircraft.replace('\\', '/').lower()
+    for match, modes in PROFILES:
+        pattern = match.lower()
+        if path and (fnmatch.fnmatchcase(path, pattern) or fnmatch.fnmatchcase(path.rsplit('/', 1)[-1], pattern)):
+            keys = set(mode[0] for mode in modes)
+            return match, [mode for mode in INTERACTIONS if mode[0] not in keys] + modes
+    return None, INTERACTIONS
+
+
+def config_changed():
+    # type: () -> bool
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except OSError:
+        return False
+    return (stat.st_mtime, stat.st_size) != _loaded
+
+
+def _validate(config, validate):
+    # type: (dict, Callable) -> (Dict[str, tuple], List[tuple], List[tuple])
+
+    phidgets = {}
+    for name, phidget in _get(config, 'phidgets', dict).items():
+        if not isinstance(phidget, list) or not 2 <= len(phidget) <= 5 or phidget[0] not in PHIDGET_TYPES \
+                or not all(isinstance(value, int) for value in phidget[1:]):
+            raise ValueError('Phidget %s: expected [%s, serial, hub port, channel, hub port device] but got %r' % (
+                name, '|'.join(sorted(PHIDGET_TYPES)), phidget))
+        phidgets[name] = tuple(phidget)
+
+    interactions = _validate_modes(_get(config, 'modes', list), phidgets, validate)
+
+    profiles = []
+    for profile in _get(config, 'aircraft', list) if 'aircraft' in config else []:
+        match = _get(profile, 'match', basestring)
+        try:
+            profiles.append((match, _validate_modes(_get(profile, 'modes', list), phidgets, validate)))
+        except ValueError as error:
+            raise ValueError('Aircraft %s: %s' % (match, error))
+
+    return phidgets, interactions, profiles
+
+
+def _validate_modes(modes, phidgets, validate):
+    # type: (list, Dict[str, tuple], Callable) -> List[tuple]
+    interactions = []
+    keys = set()
+    for mode in modes:
+        key = _get(mode, 'mode', basestring)
+        if key in keys:
+            raise ValueError('Mode %s: declared twice' % key)
+        keys.add(key)
+        declarations = []
+        for declaration in _get(mode, 'interactions', list):
+            try:
+                declarations.append(validate(declaration, phidgets))
+            except (ValueError, LookupError) as error:
+                raise ValueError('Mode %s: %s' % (key, error))
+
+        # overlay while phidget held?
+        overlay = None
+        if 'hold' in mode:
+            hold = _get(mode, 'hold', basestring)
+            if hold not in phidgets:
+                raise ValueError('Mode %s: no phidget %s to hold' % (key, hold))
+            over = _get(mode, 'over', list) if 'over' in mode else []
+            if not all(isinstance(name, basestring) for name in over):
+                raise ValueError('Mode %s: expected over [mode, ...] but got %r' % (key, over))
+            overlay = (hold, over)
+
+        interactions.append((key, _get(mode, 'description', basestring), declarations, overlay))
+    return interactions
+
+
+def _native(value):
+    # type: (object) -> object
+    # plain strings for XPLM and Phidget22 rather than unicode
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_native(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_native(key), _native(item)) for key, item in value.items())
+    return value
+
+
+def _get(config, key, value_type):
+    # type: (dict, str, type) -> object
+    if not isinstance(config, dict) or not isinstance(config.get(key), value_type):
+        raise ValueError('Expected %s in %r' % (key, config))
+    return config[key]
+
+
+def _read_cache():
+    # type: () -> Optional[dict]
+    try:
+        with open(CACHE_FILE, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+        return cached if cached.get('version') == CACHE_VERSION else None
+    except Exception:
+        return None
+
+
+def _write_cache(cached):
+    # type: (dict) -> None
+    try:
+        with open(CACHE_FILE, 'wb') as cache_file:
+            pickle.dump(cached, cache_file, pickle.HIGHEST_PROTOCOL)
+    except (IOError, OSError) as error:
+        logging.debug("Can't cache configuration: %s", error)
@@ -0,0 +1,283 @@
+import re
+from collections import deque
+from time import time
+from typing import Dict, List, Callable, Optional
+
+from XPLMDataAccess import XPLMFindDataRef, XPLMGetDataRefTypes, XPLMGetDatavf, XPLMSetDatavf, XPLMGetDatavi, \
+    XPLMSetDatavi, xplmType_FloatArray, xplmType_IntArray
+from XPLMUtilities import XPLMFindCommand, XPLMCommandOnce
+from PhidgetControlsStats import count
+
+# Configuration: commands issued per flight loop at most (the rest carried over to following flight loops),
+# and whether queued steps of a command are cancelled by steps of its opposite (e.g. up and down)
+MAX_COMMANDS_PER_LOOP = 8
+COLLAPSE_OPPOSITE_COMMANDS = False
+
+# handles of datarefs and commands by path, None if not found - those retried on aircraft load (handles found
+# stay valid for the life of X-Plane)
+_handles = {}  # type: Dict[ (str, str), object]
+
+# values of datarefs read or written during the current flight loop, and setters of those to write back
+_values = {}  # type: Dict[object, object]
+_dirty = {}  # type: Dict[object, Callable]
+
+# elements of array datarefs addressed by interactions - [start, stop, is int] by dataref, read in one go
+_ranges = {}  # type: Dict[object, list]
+
+# values of array datarefs read or written during the current flight loop, and [start, stop] written of those
+_arrays = {}  # type: Dict[object, list]
+_dirty_arrays = {}  # type: Dict[object, list]
+
+# throttled datarefs with a value held back until their interval is over, by the dataref they write
+_held = {}  # type: Dict[object, ThrottledDataRef]
+
+# commands to issue as runs of [command, times] in order
+_commands = deque()  # type: deque
+
+# e.g. sim/flightmodel/engine/ENGN_thro[0] or sim/flightmodel/engine/ENGN_thro[0:4]
+ARRAY_PATH = re.compile(r'^(.+)\[(\d+)(?::(\d+))?\]$')
+
+
+class ArrayDataRef(object):
+    """
+        Elements [start, stop) of an array dataref - read as its first element, written to all elements (e.g. one
+        knob for all engines' throttles)
+    """
+
+    def __init__(self, handle, start, stop):
+        # type: (object, int, int) -> None
+        self.handle = handle
+        self.start = start
+        self.stop = stop
+
+
+class ThrottledDataRef(object):
+    """
+        Dataref written by an interaction at most once per interval - values in between are held back (and read
+        back by the interaction), the last one written once the interval is over unless the dataref is written
+        otherwise meanwhile
+    """
+
+    def __init__(self, ref, interval):
+        # type: (object, float) -> None
+        self.ref = ref
+        self.interval = interval
+        self.written = 0.0
+        self.setter = None  # type: Optional[Callable]
+        self.value = None
+
+
+def throttled(ref, max_rate):
+    # type: (object, Optional[float]) -> object
+    # ref written at most max_rate times per second, if given
+    if not max_rate:
+        return ref
+    if max_rate < 0:
+        raise ValueError('Expected writes per second but got %r' % max_rate)
+    return ThrottledDataRef(ref, 1.0 / max_rate)
+
+
+def get_dataref(ref, getter):
+    # type: (object, Callable) -> object
+    try:
+        return _values[ref]
+    except KeyError:
+        if isinstance(ref, ArrayDataRef):
+            return _get_array(ref.handle)[ref.start - _ranges[ref.handle][0]]
+        if isinstance(ref, ThrottledDataRef):
+            return get_dataref(ref.ref, getter) if ref.value is None else ref.value
+        value = _values[ref] = getter(ref)
+        return value
+
+
+def set_dataref(ref, setter, value):
+    # type: (object, Callable, object) -> None
+    if isinstance(ref, ThrottledDataRef):
+        _set_throttled(ref, setter, value)
+        return
+    # a value held back for the dataref is stale now
+    if ref in _held:
+        _held.pop(ref).value = None
+    if isinstance(ref, ArrayDataRef):
+        _set_array(ref, value)
+        return
+    _values[ref] = value
+    _dirty[ref] = setter
+
+
+def flush_datarefs():
+    # type: () -> int
+    # returns number of values still held back by throttling - written by a later flush
+    try:
+        # trailing writes of throttled datarefs due
+        if _held:
+            now = time()
+            for ref in [ref for ref in _held.values() if now - ref.written >= ref.interval]:
+                del _held[ref.ref]
+                _write_throttled(ref, ref.setter, ref.value, now)
+        for ref, setter in _dirty.items():
+            setter(ref, _values[ref])
+        # one call per array dataref for all elements written
+        for handle, (start, stop) in _dirty_arrays.items():
+            offset, _, is_int = _ranges[handle]
+            setter = XPLMSetDatavi if is_int else XPLMSetDatavf
+            setter(handle, _arrays[handle][start - offset:stop - offset], start, stop - start)
+    finally:
+        _dirty.clear()
+        _values.clear()
+        _dirty_arrays.clear()
+        _arrays.clear()
+    return len(_held)
+
+
+def _get_array(handle):
+    # type: (object) -> List
+    # one call per array dataref for all elements addressed
+    try:
+        return _arrays[handle]
+    except KeyError:
+        start, stop, is_int = _ranges[handle]
+        values = []
+        (XPLMGetDatavi if is_int else XPLMGetDatavf)(handle, values, start, stop - start)
+        # short arrays read as 0 beyond their end
+        values.extend([0] * (stop - start - len(values)))
+        values = _arrays[handle] = [int(value) if is_int else float(value) for value in values]
+        return values
+
+
+def _set_array(ref, value):
+    # type: (ArrayDataRef, object) -> None
+    values = _get_array(ref.handle)
+    offset, _, is_int = _ranges[ref.handle]
+    value = int(value) if is_int else float(value)
+    for index in range(ref.start - offset, ref.stop - offset):
+        values[index] = value
+    dirty = _dirty_arrays.get(ref.handle)
+    if dirty:
+        dirty[0] = min(dirty[0], ref.start)
+        dirty[1] = max(dirty[1], ref.stop)
+    else:
+        _dirty_arrays[ref.handle] = [ref.start, ref.stop]
+
+
+def _set_throttled(ref, setter, value):
+    # type: (ThrottledDataRef, Callable, object) -> None
+    now = time()
+    if ref.value is None and now - ref.written >= ref.interval:
+        _write_throttled(ref, setter, value, now)
+        return
+    # hold back until interval is over, replacing a value held back before (by this or another interaction)
+    if ref.value is not None:
+        count('suppressed writes')
+    held = _held.get(ref.ref)
+    if held is not None and held is not ref:
+        held.value = None
+    ref.setter = setter
+    ref.value = value
+    _held[ref.ref] = ref
+
+
+def release_throttled(ref=None):
+    # type: (Optional[ThrottledDataRef]) -> None
+    # write values held back (those of ref only, if given) with the next flush rather than once due
+    for held in [held for held in _held.values() if ref is None or held is ref]:
+        del _held[held.ref]
+        _write_throttled(held, held.setter, held.value, time())
+
+
+def _write_throttled(ref, setter, value, now):
+    # type: (ThrottledDataRef, Callable, object, float) -> None
+    ref.written = now
+    ref.value = None
+    count('throttled writes')
+    set_dataref(ref.ref, setter, value)
+
+
+def queue_command(command, times=1, opposite=None):
+    # type: (object, int, Optional[object]) -> None
+    last = _commands[-1] if _commands else None
+    if last and opposite is not None and last[0] == opposite and COLLAPSE_OPPOSITE_COMMANDS:
+        cancelled = min(times, last[1])
+        last[1] -= cancelled
+        times -= cancelled
+        if not last[1]:
+            _commands.pop()
+            last = _commands[-1] if _commands else None
+    if not times:
+        return
+    if last and last[0] == command:
+        last[1] += times
+    else:
+        _commands.append([command, times])
+
+
+def flush_commands():
+    # type: () -> int
+    # issue queued commands up to the limit per flight loop, returns number of commands still queued
+    issued = 0
+    while _commands and issued < MAX_COMMANDS_PER_LOOP:
+        run = _commands[0]
+        run[1] -= 1
+        if not run[1]:
+            _commands.popleft()
+        issued += 1
+        XPLMCommandOnce(run[0])
+    return sum(times for _, times in _commands)
+
+
+def find_dataref(path):
+    # type: (str) -> object
+    match = ARRAY_PATH.match(path)
+    if not match:
+        return _find('dataref', path, XPLMFindDataRef)
+    return _find('dataref', path, lambda _: _find_array(*match.groups()))
+
+
+def _find_array(path, start, stop):
+    # type: (str, str, Optional[str]) -> Optional[ArrayDataRef]
+    handle = _find('dataref', path, XPLMFindDataRef)
+    start = int(start)
+    stop = int(stop) if stop is not None else start + 1
+    if stop <= start:
+        raise ValueError('Empty elements %i:%i of dataref %s' % (start, stop, path))
+    types = XPLMGetDataRefTypes(handle)
+    if not types & (xplmType_FloatArray | xplmType_IntArray):
+        raise LookupError('No array dataref %s' % path)
+
+    # widen elements read of the array to include these - read once first, so backends mirroring values (e.g.
+    # over UDP) have all of them before the first tick
+    is_int = not types & xplmType_FloatArray
+    addressed = _ranges.get(handle) or [start, stop, is_int]
+    first, last = min(addressed[0], start), max(addressed[1], stop)
+    (XPLMGetDatavi if is_int else XPLMGetDatavf)(handle, [], first, last - first)
+    addressed[0], addressed[1] = first, last
+    _ranges[handle] = addressed
+    return ArrayDataRef(handle, start, stop)
+
+
+def find_command(path):
+    # type: (str) -> object
+    return _find('command', path, XPLMFindCommand)
+
+
+def invalidate_handles():
+    # type: () -> None
+    # forget datarefs and commands not found, e.g. those of a previous aircraft's plugin
+    for key in [key for key, handle in _handles.items() if not handle]:
+        del _handles[key]
+    _commands.clear()
+    for ref in _held.values():
+        ref.value = None
+    _held.clear()
+
+
+def _find(kind, path, finder):
+    # type: (str, str, Callable) -> object
+    key = (kind, path)
+    try:
+        handle = _handles[key]
+    except KeyError:
+        handle = _handles[key] = finder(path)
+    if not handle:
+        raise LookupError('No %s %s' % (kind, path))
+    return handle
@@ -0,0 +1,124 @@
+import threading
+from collections import deque, namedtuple
+from time import time
+from typing import Dict, List, Optional
+
+# Configuration: maximum number of timestamped changes kept per channel between drains
+MAX_PENDING_CHANGES = 256
+
+# address of a phidget channel - hub port and channel -1 for any, hub port device for a VINT hub port used
+# directly (e.g. as digital input)
+Device = namedtuple('Device', 'type serial hub_port channel hub_port_device')
+
+
+def device(phidget_type, serial, hub_port=-1, channel=-1, hub_port_device=False):
+    # type: (type, int, int, int, bool) -> Device
+    return Device(phidget_type, serial, hub_port, channel, bool(hub_port_device))
+
+
+def device_name(key):
+    # type: (Device) -> str
+    # e.g. Encoder#82081, DigitalInput#620001/3 or DigitalInput#82081:5
+    name = '%s#%i' % (getattr(key.type, '__name__', key.type), key.serial)
+    if key.hub_port >= 0:
+        name += '/%i' % key.hub_port
+    if key.channel >= 0:
+        name += ':%i' % key.channel
+    return name
+
+
+class InputChannel(object):
+    """
+        Flight loop side view of a phidget's input - only updated by InputAccumulator.drain()
+        so interactions read positions and states without any device I/O
+    """
+
+    def __init__(self, key):
+        # type: (Device) -> None
+        self.key = key
+        self.position = 0
+        self.state = None
+        self.changes = []  # type: List[ (float, object) ]
+        self.sequence = 0
+
+    def getPosition(self):
+        # type: () -> int
+        return self.position
+
+    def getState(self):
+        # type: () -> object
+        return self.state
+
+
+class InputAccumulator(object):
+    """
+        Collects timestamped changes reported by phidget change handlers (on Phidget22 threads)
+        until the flight loop drains them once per tick
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}  # type: Dict[object, InputChannel]
+        self.positions = {}  # type: Dict[object, int]
+        self.states = {}  # type: Dict[object, object]
+        self.pending = {}  # type: Dict[object, deque]
+        self.drained = []  # type: List[InputChannel]
+
+    def channel(self, key):
+        # type: (object) -> InputChannel
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = InputChannel(key)
+        return channel
+
+    def positionChanged(self, key, position_change, timestamp=None):
+        # type: (object, int, Optional[float]) -> None
+        now = timestamp or time()
+        with self.lock:
+            self.positions[key] = self.positions.get(key, 0) + position_change
+            self._pending(key).append((now, position_change))
+
+    def stateChanged(self, key, state, timestamp=None):
+        # type: (object, object, Optional[float]) -> None
+        now = timestamp or time()
+        with self.lock:
+            self.states[key] = state
+            self._pending(key).append((now, state))
+
+    def drain(self):
+        # type: () -> List[InputChannel]
+
+        # changes of the previous drain are done
+        for channel in self.drained:
+            channel.changes = []
+
+        # take what's pending
+        with self.lock:
+            if not self.pending:
+                self.drained = []
+                return self.drained
+            pending, self.pending = self.pending, {}
+            positions = [(key, self.positions.get(key)) for key in pending]
+            states = [(key, self.states.get(key)) for key in pending]
+
+        # publish to channels
+        drained = []
+        for (key, position), (_, state) in zip(positions, states):
+            channel = self.channel(key)
+            if position is not None:
+                channel.position = position
+            if state is not None:
+                channel.state = state
+            channel.changes = list(pending[key])
+            channel.sequence += 1
+            drained.append(channel)
+
+        self.drained = drained
+        return drained
+
+    def _pending(self, key):
+        # type: (object) -> deque
+        changes = self.pending.get(key)
+        if changes is None:
+            changes = self.pending[key] = deque(maxlen=MAX_PENDING_CHANGES)
+        return changes
@@ -0,0 +1,107 @@
+"""
+    Records input as seen by the flight loop - every flight loop with the changes drained in it, and mode
+    switches - into a compact append-only binary log for deterministic replay (see PhidgetControlsSimulator.py)
+
+    Log: magic 'PCL3' followed by records of loop sequence, timestamp, serial, value, type code, kind, hub port,
+    channel and hub port device - value is an encoder's position after a change, a digital input's state, or the
+    length of the mode name following. The log starts with a snapshot of each input's position or state when
+    recording started, so replay starts from the same input
+"""
+import os
+import struct
+import time
+from typing import Iterator
+
+# Configuration: record input from plugin start, directory of logs, bytes buffered before writing to a log
+RECORD_INPUT = False
+RECORD_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+RECORD_BUFFER = 65536
+
+MAGIC = 'PCL3'
+RECORD = struct.Struct('<IdiiBBbbB3x')
+LOOP, POSITION, STATE, MODE, SNAPSHOT = 0, 1, 2, 3, 4
+
+# phidget types by code in records, and kind of changes they report
+RECORD_TYPES = ('Encoder', 'DigitalInput')
+RECORD_KINDS = {'Encoder': POSITION, 'DigitalInput': STATE}
+
+
+class Recorder(object):
+
+    def __init__(self, path=None):
+        # type: (str) -> None
+        self.path = path or os.path.join(RECORD_DIRECTORY, time.strftime('PhidgetControls-%Y%m%d-%H%M%S.rec'))
+        self.file = open(self.path, 'wb')
+        self.buffer = bytearray(MAGIC)
+
+    def snapshot(self, sequence, timestamp, channels):
+        # type: (int, float, list) -> None
+        # positions and states of inputs as of the last drain
+        for channel in channels:
+            key = channel.key
+            type_name = key.type.__name__
+            if type_name not in RECORD_TYPES:
+                continue
+            if RECORD_KINDS[type_name] == POSITION:
+                value = channel.position
+            elif channel.state is not None:
+                value = int(channel.state)
+            else:
+                continue
+            self.buffer += RECORD.pack(sequence, timestamp, key.serial, value, RECORD_TYPES.index(type_name),
+                                       SNAPSHOT, key.hub_port, key.channel, key.hub_port_device)
+
+    def loop(self, sequence, timestamp, changed):
+        # type: (int, float, list) -> None
+        self.buffer += RECORD.pack(sequence, timestamp, 0, 0, 0, LOOP, -1, -1, 0)
+        for channel in changed:
+            key = channel.key
+            type_name = key.type.__name__
+            type_code = RECORD_TYPES.index(type_name)
+            kind = RECORD_KINDS[type_name]
+            if kind == POSITION:
+                # positions after each change rather than changes, so replay starts at the same position
+                position = channel.position - sum(value for _, value in channel.changes)
+                for change_timestamp, value in channel.changes:
+                    position += value
+                    self.buffer += RECORD.pack(sequence, change_timestamp, key.serial, position, type_code, kind,
+                                               key.hub_port, key.channel, key.hub_port_device)
+            else:
+                for change_timestamp, value in channel.changes:
+                    self.buffer += RECORD.pack(sequence, change_timestamp, key.serial, int(value), type_code, kind,
+                                               key.hub_port, key.channel, key.hub_port_device)
+        if len(self.buffer) >= RECORD_BUFFER:
+            self.flush()
+
+    def mode(self, sequence, timestamp, mode):
+        # type: (int, float, str) -> None
+        self.buffer += RECORD.pack(sequence, timestamp, 0, len(mode), 0, MODE, -1, -1, 0)
+        self.buffer += mode
+
+    def flush(self):
+        # type: () -> None
+        self.file.write(self.buffer)
+        del self.buffer[:]
+
+    def close(self):
+        # type: () -> None
+        self.flush()
+        self.file.close()
+
+
+def read_log(path):
+    # type: (str) -> Iterator[ (int, float, int, str, tuple, object)]
+    # records as (loop sequence, timestamp, kind, type name, (serial, hub port, channel, hub port device), value
+    # or mode)
+    with open(path, 'rb') as log_file:
+        data = log_file.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not an input log %s' % path)
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        sequence, timestamp, serial, value, type_code, kind, hub_port, channel, hub_port_device = RECORD.unpack_from(
+            data, offset)
+        offset += RECORD.size
+        if kind == MODE:
+            value, offset = data[offset:offset + value], offset + value
+        yield sequence, timestamp, kind, RECORD_TYPES[type_code], (serial, hub_port, channel, hub_port_device), value
@@ -0,0 +1,571 @@
+"""
+    Phidget Controls Simulator - run PythonInterface headless against an in-memory dataref store,
+    a command recorder and scripted virtual Encoders and DigitalInputs instead of X-Plane and Phidget22
+
+    Usage:
+      python PhidgetControlsSimulator.py [--polling] [--trace] [--stats] SCRIPT
+
+    Script, one step per line (# starts a comment):
+      mode COM1               trigger mode command fscode/phidgetcontrols/COM1
+      command sim/GPS/foo     trigger a command
+      aircraft [PATH]         send aircraft loaded message (after loading aircraft PATH)
+      set sim/cockpit/foo 1.5 set a dataref value (float if containing '.', array if separated by ',')
+      turn E1 10              move encoder E1 by 10 positions
+      press D1                set digital input D1
+      release D1              clear digital input D1
+      loop 100                run 100 flight loops
+      sleep 0.5               wait 0.5 seconds (real time)
+      replay FILE             replay input log recorded via fscode/phidgetcontrols/record, one flight loop
+                              per recorded flight loop at recorded times
+"""
+import argparse
+import logging
+import sys
+import types
+from timeit import default_timer
+from typing import Dict, List, Callable, Optional
+
+# seconds assumed per frame for flight loops scheduled in frames
+FRAME_TIME = 1 / 60.0
+
+XPLM_MSG_PLANE_LOADED = 102
+
+
+class SimulatedXPlane(object):
+    """
+        XPLM functions backed by an in-memory dataref store and a command recorder
+    """
+
+    def __init__(self):
+        self.datarefs = {}  # type: Dict[str, object]
+        self.commands = []  # type: List[ (int, str) ]
+        self.handlers = {}  # type: Dict[str, List[Callable]]
+        self.flight_loops = {}  # type: Dict[int, list]
+        self.accessors = {}  # type: Dict[str, tuple]
+        self.aircraft = 'Aircraft/Laminar Research/Cessna 172SP/Cessna_172SP.acf'
+        self.missing = set()  # type: set
+        self.reads = 0
+        self.writes = 0
+        self.loop = 0
+        self.trace = False
+
+    # XPLMProcessing
+    def XPLMCreateFlightLoop(self, _plugin, params):
+        flight_loop = len(self.flight_loops) + 1
+        self.flight_loops[flight_loop] = [params[1], 0, params[2]]
+        return flight_loop
+
+    def XPLMScheduleFlightLoop(self, _plugin, flight_loop, interval, _relative):
+        self.flight_loops[flight_loop][1] = interval
+
+    def XPLMDestroyFlightLoop(self, _plugin, flight_loop):
+        del self.flight_loops[flight_loop]
+
+    # XPLMDataAccess
+    def XPLMFindDataRef(self, path):
+        return path if path not in self.missing else None
+
+    def XPLMGetDatai(self, ref):
+        self.reads += 1
+        if ref in self.accessors:
+            return self.accessors[ref][0](None)
+        return int(self.datarefs.get(ref, 0))
+
+    def XPLMGetDataf(self, ref):
+        self.reads += 1
+        if ref in self.accessors:
+            return self.accessors[ref][1](None)
+        return float(self.datarefs.get(ref, 0.0))
+
+    def XPLMSetDatai(self, ref, value):
+        self.writes += 1
+        self.datarefs[ref] = int(value)
+        if self.trace:
+            print('%6i %s = %s' % (self.loop, ref, self.datarefs[ref]))
+
+    def XPLMSetDataf(self, ref, value):
+        self.writes += 1
+        self.datarefs[ref] = float(value)
+        if self.trace:
+            print('%6i %s = %s' % (self.loop, ref, self.datarefs[ref]))
+
+    def XPLMGetDataRefTypes(self, ref):
+        value = self.datarefs.get(ref)
+        if isinstance(value, list):
+            return 16 if all(isinstance(element, int) for element in value) else 8
+        return 1 | 2 | 4
+
+    def XPLMGetDatavi(self, ref, values, offset, count):
+        return self._getArray(ref, values, offset, count, int)
+
+    def XPLMGetDatavf(self, ref, values, offset, count):
+        return self._getArray(ref, values, offset, count, float)
+
+    def _getArray(self, ref, values, offset, count, element_type):
+        self.reads += 1
+        elements = self.datarefs.get(ref, [])[offset:offset + count]
+        values.extend(element_type(element) for element in elements)
+        return len(elements)
+
+    def XPLMSetDatavi(self, ref, values, offset, count):
+        self._setArray(ref, values, offset, count, int)
+
+    def XPLMSetDatavf(self, ref, values, offset, count):
+        self._setArray(ref, values, offset, count, float)
+
+    def _setArray(self, ref, values, offset, count, element_type):
+        self.writes += 1
+        elements = self.datarefs.setdefault(ref, [])
+        elements.extend([element_type(0)] * (offset + count - len(elements)))
+        elements[offset:offset + count] = [element_type(value) for value in values[:count]]
+        if self.trace:
+            print('%6i %s[%i:%i] = %s' % (self.loop, ref, offset, offset + count, elements[offset:offset + count]))
+
+    def XPLMRegisterDataAccessor(self, _plugin, path, _type, _writable, read_int, _write_int, read_float, *_args):
+        self.accessors[path] = (read_int, read_float)
+        return path
+
+    def XPLMUnregisterDataAccessor(self, _plugin, ref):
+        del self.accessors[ref]
+
+    # XPLMPlugin
+    # noinspection PyMethodMayBeStatic
+    def XPLMFindPluginBySignature(self, _signature):
+        return -1
+
+    def XPLMSendMessageToPlugin(self, _plugin, _message, _param):
+        pass
+
+    # XPLMPlanes
+    def XPLMGetNthAircraftModel(self, index, file_name, path):
+        if index == 0 and self.aircraft:
+            file_name.append(self.aircraft.replace('\\', '/').rsplit('/', 1)[-1])
+            path.append(self.aircraft)
+
+    # XPLMUtilities
+    # noinspection PyMethodMayBeStatic
+    def XPLMDebugString(self, message):
+        sys.stderr.write(message)
+
+    # noinspection PyMethodMayBeStatic
+    def XPLMFindCommand(self, path):
+        return path
+
+    # noinspection PyMethodMayBeStatic
+    def XPLMCreateCommand(self, path, _description):
+        return path
+
+    def XPLMCommandOnce(self, command):
+        self.commands.append((self.loop, command))
+        if self.trace:
+            print('%6i %s' % (self.loop, command))
+        for callback in self.handlers.get(command, []):
+            callback(command, 0, None)
+            callback(command, 2, None)
+
+    def XPLMRegisterCommandHandler(self, _plugin, command, callback, _before, _refcon):
+        self.handlers.setdefault(command, []).append(callback)
+
+    def XPLMUnregisterCommandHandler(self, _plugin, command, callback, _before, _refcon):
+        self.handlers.get(command, []).remove(callback)
+
+    # SandyBarbourUtilities
+    def SandyBarbourPrint(self, message):
+        pass
+
+    def modules(self):
+        # type: () -> Dict[str, types.ModuleType]
+        return {
+            'XPLMProcessing': _module('XPLMProcessing', self, [
+                'XPLMCreateFlightLoop', 'XPLMScheduleFlightLoop', 'XPLMDestroyFlightLoop']),
+            'XPLMDefs': _module('XPLMDefs', XPLM_NO_PLUGIN_ID=-1),
+            'XPLMDataAccess': _module('XPLMDataAccess', self, [
+                'XPLMFindDataRef', 'XPLMGetDatai', 'XPLMSetDatai', 'XPLMGetDataf', 'XPLMSetDataf',
+                'XPLMGetDataRefTypes', 'XPLMGetDatavi', 'XPLMSetDatavi', 'XPLMGetDatavf', 'XPLMSetDatavf',
+                'XPLMRegisterDataAccessor', 'XPLMUnregisterDataAccessor'], xplmType_Int=1, xplmType_Float=2,
+                xplmType_Double=4, xplmType_FloatArray=8, xplmType_IntArray=16, xplmType_Data=32),
+            'XPLMPlugin': _module('XPLMPlugin', self, [
+                'XPLMFindPluginBySignature', 'XPLMSendMessageToPlugin'], XPLM_MSG_PLANE_LOADED=XPLM_MSG_PLANE_LOADED),
+            'XPLMPlanes': _module('XPLMPlanes', self, ['XPLMGetNthAircraftModel']),
+            'XPLMUtilities': _module('XPLMUtilities', self, [
+                'XPLMDebugString', 'XPLMFindCommand', 'XPLMCommandOnce', 'XPLMCreateCommand',
+                'XPLMRegisterCommandHandler', 'XPLMUnregisterCommandHandler']),
+            'SandyBarbourUtilities': _module('SandyBarbourUtilities', self, ['SandyBarbourPrint'])
+        }
+
+    def runFlightLoops(self):
+        # type: () -> None
+        self.loop += 1
+        for flight_loop in list(self.flight_loops.values()):
+            callback, interval, refcon = flight_loop
+            elapsed = interval if interval > 0 else -interval * FRAME_TIME
+            flight_loop[1] = callback(elapsed, elapsed, self.loop, refcon)
+
+
+# Phidget22 stand-ins
+class ErrorCode(object):
+    EPHIDGET_UNKNOWNVAL = 51
+    EPHIDGET_NOTATTACHED = 52
+
+
+class PhidgetException(Exception):
+    def __init__(self, code, description=''):
+        Exception.__init__(self, description)
+        self.code = code
+        self.description = description
+
+
+class Phidget(object):
+
+    instances = []  # type: List[Phidget]
+
+    def __init__(self):
+        self.serial = -1
+        self.hub_port = -1
+        self.channel = -1
+        self.hub_port_device = False
+        self.attached = False
+        self.on_attach = None  # type: Optional[Callable]
+        self.on_detach = None  # type: Optional[Callable]
+        Phidget.instances.append(self)
+
+    def setDeviceSerialNumber(self, serial):
+        self.serial = serial
+
+    def getDeviceSerialNumber(self):
+        return self.serial
+
+    def setHubPort(self, hub_port):
+        self.hub_port = hub_port
+
+    def setIsHubPortDevice(self, hub_port_device):
+        self.hub_port_device = hub_port_device
+
+    def setChannel(self, channel):
+        self.channel = channel
+
+    def setOnAttachHandler(self, handler):
+        self.on_attach = handler
+
+    def setOnDetachHandler(self, handler):
+        self.on_detach = handler
+
+    def getAttached(self):
+        return self.attached
+
+    def open(self):
+        self.attached = True
+        if self.on_attach:
+            self.on_attach(self)
+
+    def openWaitForAttachment(self, _timeout):
+        self.open()
+
+    def close(self):
+        if self.attached and self.on_detach:
+            self.on_detach(self)
+        self.attached = False
+
+
+class Encoder(Phidget):
+
+    def __init__(self):
+        Phidget.__init__(self)
+        self.position = 0
+        self.on_position_change = None  # type: Optional[Callable]
+
+    def setOnPositionChangeHandler(self, handler):
+        self.on_position_change = handler
+
+    def getPosition(self):
+        return self.position
+
+    def turn(self, position_change):
+        # type: (int) -> None
+        self.position += position_change
+        if self.on_position_change:
+            self.on_position_change(self, position_change, 0.0, False)
+
+
+class DigitalInput(Phidget):
+
+    def __init__(self):
+        Phidget.__init__(self)
+        self.state = False
+        self.on_state_change = None  # type: Optional[Callable]
+
+    def setOnStateChangeHandler(self, handler):
+        self.on_state_change = handler
+
+    def getState(self):
+        return self.state
+
+    def press(self, state):
+        # type: (bool) -> None
+        if state == self.state:
+            return
+        self.state = state
+        if self.on_state_change:
+            self.on_state_change(self, state)
+
+
+class DigitalOutput(Phidget):
+
+    def __init__(self):
+        Phidget.__init__(self)
+        self.state = False
+        self.duty_cycle = 0.0
+        self.writes = 0
+
+    def setState(self, state):
+        self.state = state
+        self.writes += 1
+
+    def setDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self.writes += 1
+
+
+class LCD(Phidget):
+
+    def __init__(self):
+        Phidget.__init__(self)
+        self.rows = {}  # type: Dict[int, str]
+        self.writes = 0
+
+    def writeText(self, _font, x, y, text):
+        row = self.rows.get(y, '')
+        self.rows[y] = row[:x].ljust(x) + text + row[x + len(text):]
+        self.writes += 1
+
+    def flush(self):
+        pass
+
+
+class LCDFont(object):
+    FONT_5x8 = 4
+
+
+def phidget_modules():
+    # type: () -> Dict[str, types.ModuleType]
+    modules = {
+        'Phidget22': _module('Phidget22'),
+        'Phidget22.Phidget': _module('Phidget22.Phidget', Phidget=Phidget),
+        'Phidget22.PhidgetException': _module('Phidget22.PhidgetException', PhidgetException=PhidgetException),
+        'Phidget22.ErrorCode': _module('Phidget22.ErrorCode', ErrorCode=ErrorCode),
+        'Phidget22.Devices': _module('Phidget22.Devices'),
+        'Phidget22.Devices.Encoder': _module('Phidget22.Devices.Encoder', Encoder=Encoder),
+        'Phidget22.Devices.DigitalInput': _module('Phidget22.Devices.DigitalInput', DigitalInput=DigitalInput),
+        'Phidget22.Devices.DigitalOutput': _module('Phidget22.Devices.DigitalOutput', DigitalOutput=DigitalOutput),
+        'Phidget22.Devices.LCD': _module('Phidget22.Devices.LCD', LCD=LCD),
+        'Phidget22.LCDFont': _module('Phidget22.LCDFont', LCDFont=LCDFont)
+    }
+    # packages need their submodules as attributes for 'from package import module'
+    for name, module in modules.items():
+        if '.' in name:
+            package, attribute = name.rsplit('.', 1)
+            setattr(modules[package], attribute, module)
+    return modules
+
+
+def _module(name, source=None, functions=(), **attributes):
+    module = types.ModuleType(name)
+    for function in functions:
+        setattr(module, function, getattr(source, function))
+    for key, value in attributes.items():
+        setattr(module, key, value)
+    return module
+
+
+def install(xplane, virtual_phidgets=True):
+    # type: (SimulatedXPlane, bool) -> None
+    sys.modules.update(xplane.modules())
+    if virtual_phidgets:
+        sys.modules.update(phidget_modules())
+
+
+def get_virtual_phidget(name):
+    # type: (str) -> Phidget
+    from PhidgetControlsConfig import PHIDGETS
+    key = PHIDGETS[name]
+    for phidget in Phidget.instances:
+        if isinstance(phidget, key.type) and (phidget.serial, phidget.hub_port, phidget.channel) == (
+                key.serial, key.hub_port, key.channel):
+            return phidget
+    raise KeyError('No virtual phidget %s' % name)
+
+
+class Simulation(object):
+    """
+        Runs a plugin instance against a simulated X-Plane, collecting per-tick cost
+    """
+
+    def __init__(self, xplane, plugin):
+        self.xplane = xplane
+        self.plugin = plugin
+        self.durations = []  # type: List[float]
+
+    def loop(self, count=1):
+        # type: (int) -> None
+        for _ in range(count):
+            start = default_timer()
+            self.xplane.runFlightLoops()
+            self.durations.append(default_timer() - start)
+
+    def step(self, line):
+        # type: (str) -> None
+        from time import sleep
+
+        words = line.split('#', 1)[0].split()
+        if not words:
+            return
+        action, args = words[0], words[1:]
+        if action == 'mode':
+            self.command('fscode/phidgetcontrols/' + args[0])
+        elif action == 'command':
+            self.command(args[0])
+        elif action == 'aircraft':
+            if args:
+                self.xplane.aircraft = ' '.join(args)
+            self.plugin.XPluginReceiveMessage(0, XPLM_MSG_PLANE_LOADED, 0)
+        elif action == 'set':
+            values = [float(value) if '.' in args[1] else int(value) for value in args[1].split(',')]
+            self.xplane.datarefs[args[0]] = values if ',' in args[1] else values[0]
+        elif action == 'turn':
+            get_virtual_phidget(args[0]).turn(int(args[1]))
+        elif action == 'press':
+            get_virtual_phidget(args[0]).press(True)
+        elif action == 'release':
+            get_virtual_phidget(args[0]).press(False)
+        elif action == 'loop':
+            self.loop(int(args[0]) if args else 1)
+        elif action == 'sleep':
+            sleep(float(args[0]))
+        elif action == 'replay':
+            self.replay(args[0])
+        else:
+            raise ValueError('Unknown step %s' % line.strip())
+
+    def replay(self, path):
+        # type: (str) -> None
+        import PI_PhidgetControls
+        import PhidgetControlsCache
+        import PhidgetControlsDataRefs
+        from PhidgetControlsConfig import PHIDGET_TYPES
+        from PhidgetControlsInput import device
+        from PhidgetControlsRecorder import read_log, LOOP, MODE, POSITION, SNAPSHOT, RECORD_KINDS
+
+        # interactions see recorded time for the replay only
+        clock = [0.0]
+        clocks = PI_PhidgetControls.time, PhidgetControlsDataRefs.time
+        PI_PhidgetControls.time = PhidgetControlsDataRefs.time = lambda: clock[0]
+        inputs = PhidgetControlsCache._inputs
+        positions = {}  # type: Dict[object, int]
+
+        # start from freshly compiled interactions like recording did
+        self.plugin.compiled.clear()
+
+        looping = False
+        try:
+            for _sequence, timestamp, kind, type_name, address, value in read_log(path):
+                if kind in (LOOP, MODE) and looping:
+                    self.loop()
+                    looping = False
+                if kind == LOOP:
+                    clock[0] = timestamp
+                    looping = True
+                elif kind == MODE:
+                    self.command('fscode/phidgetcontrols/' + value)
+                elif kind == SNAPSHOT:
+                    # input as when recording started, without a change to drain
+                    key = device(PHIDGET_TYPES[type_name], *address)
+                    channel = inputs.channel(key)
+                    if RECORD_KINDS[type_name] == POSITION:
+                        channel.position = inputs.positions[key] = positions[key] = value
+                    else:
+                        channel.state = inputs.states[key] = value
+                elif kind == POSITION:
+                    key = device(PHIDGET_TYPES[type_name], *address)
+                    inputs.positionChanged(key, value - positions.get(key, 0), timestamp)
+                    positions[key] = value
+                else:
+                    inputs.stateChanged(device(PHIDGET_TYPES[type_name], *address), value, timestamp)
+            if looping:
+                self.loop()
+        finally:
+            PI_PhidgetControls.time, PhidgetControlsDataRefs.time = clocks
+
+    def command(self, path):
+        # type: (str) -> None
+        for callback in self.xplane.handlers.get(path, []):
+            callback(path, 0, None)
+            callback(path, 2, None)
+
+    def report(self):
+        # type: () -> List[str]
+        durations = sorted(self.durations) or [0.0]
+        lines = [
+            'loops: %i' % len(self.durations),
+            'handle_loop: mean %.1fus, p50 %.1fus, p99 %.1fus, max %.1fus' % (
+                sum(durations) * 1e6 / len(durations), durations[len(durations) // 2] * 1e6,
+                durations[int(len(durations) * 0.99)] * 1e6, durations[-1] * 1e6),
+            'dataref reads: %i, writes: %i, commands: %i' % (
+                self.xplane.reads, self.xplane.writes, len(self.xplane.commands))]
+        for ref in sorted(self.xplane.datarefs):
+            lines.append('%s = %s' % (ref, self.xplane.datarefs[ref]))
+        for phidget in Phidget.instances:
+            if isinstance(phidget, LCD):
+                for row in sorted(phidget.rows):
+                    lines.append('LCD#%i %i: %s (%i writes)' % (phidget.serial, row, phidget.rows[row], phidget.writes))
+            elif isinstance(phidget, DigitalOutput):
+                lines.append('DigitalOutput#%i: %s %.2f (%i writes)' % (
+                    phidget.serial, phidget.state, phidget.duty_cycle, phidget.writes))
+        return lines
+
+
+def start(xplane, event_input=True):
+    # type: (SimulatedXPlane, bool) -> Simulation
+    import PhidgetControlsCache
+    PhidgetControlsCache.EVENT_INPUT = event_input
+
+    from PI_PhidgetControls import PythonInterface
+    plugin = PythonInterface()
+    plugin.XPluginStart()
+    plugin.XPluginEnable()
+    return Simulation(xplane, plugin)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay an input script through PhidgetControls')
+    parser.add_argument('script', help='input script file')
+    parser.add_argument('--polling', action='store_true', help='poll phidgets instead of change handlers')
+    parser.add_argument('--trace', action='store_true', help='print dataref writes and commands as they happen')
+    parser.add_argument('--stats', action='store_true', help='collect and print flight loop statistics')
+    args = parser.parse_args(argv)
+
+    import PhidgetControlsStats
+    PhidgetControlsStats.STATS_ENABLED = args.stats
+
+    xplane = SimulatedXPlane()
+    xplane.trace = args.trace
+    install(xplane)
+
+    simulation = start(xplane, not args.polling)
+    logging.root.setLevel(logging.WARNING)
+    try:
+        with open(args.script) as script:
+            for line in script:
+                simulation.step(line)
+    finally:
+        simulation.plugin.XPluginStop()
+
+    for line in simulation.report():
+        print(line)
+    if args.stats:
+        from PhidgetControlsStats import report_stats
+        for line in report_stats():
+            print(line)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
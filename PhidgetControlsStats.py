@@ -0,0 +1,174 @@
+import logging
+from typing import Dict, List
+
+# Configuration: collect flight loop statistics, warn about flight loops slower than SLOW_TICK_WARNING seconds
+STATS_ENABLED = False
+SLOW_TICK_WARNING = 0.005
+
+# custom datarefs published as fscode/phidgetcontrols/stats/<name>
+STATS_DATAREF_PREFIX = 'fscode/phidgetcontrols/stats/'
+
+# DataRefEditor/DataRefTool announcement of custom datarefs
+DATAREF_EDITOR_SIGNATURE = 'xplanesdk.examples.DataRefEditor'
+DATAREF_EDITOR_MSG_ADD_DATAREF = 0x01000000
+
+
+class Histogram(object):
+    """
+        Fixed-size histogram of durations - bucket n counts durations below 2^n microseconds
+    """
+
+    BUCKETS = 24
+
+    __slots__ = ('counts', 'count', 'total', 'last', 'max')
+
+    def __init__(self):
+        self.counts = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        # type: (float) -> None
+        micros = int(seconds * 1000000)
+        self.counts[min(micros.bit_length(), Histogram.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        # type: () -> float
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        # type: (float) -> float
+        # upper bound in seconds of the bucket containing given fraction of durations
+        threshold = self.count * fraction
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return (1 << bucket) / 1000000.0
+        return 0.0
+
+    def describe(self):
+        # type: () -> str
+        return 'n %i, mean %.1fus, p50 <%.0fus, p99 <%.0fus, max %.1fus' % (
+            self.count, self.mean() * 1e6, self.percentile(0.5) * 1e6, self.percentile(0.99) * 1e6,
+            self.max * 1e6)
+
+
+class CountingPhidget(object):
+    """
+        Polled phidget counting calls for statistics
+    """
+
+    def __init__(self, phidget):
+        self.phidget = phidget
+
+    def getPosition(self):
+        count('phidget calls')
+        return self.phidget.getPosition()
+
+    def getState(self):
+        count('phidget calls')
+        return self.phidget.getState()
+
+
+_loop = Histogram()
+_ticks = {}  # type: Dict[str, Histogram]
+_counters = {}  # type: Dict[str, int]
+_datarefs = []  # type: List[object]
+_callbacks = []  # type: List[callable]
+
+
+def count(name, increment=1):
+    # type: (str, int) -> None
+    _counters[name] = _counters.get(name, 0) + increment
+
+
+def add_loop(seconds):
+    # type: (float) -> None
+    _loop.add(seconds)
+    if seconds > SLOW_TICK_WARNING:
+        count('slow loops')
+        logging.warning('Slow flight loop %.1fms', seconds * 1000)
+
+
+def add_tick(label, seconds):
+    # type: (str, float) -> None
+    histogram = _ticks.get(label)
+    if histogram is None:
+        histogram = _ticks[label] = Histogram()
+    histogram.add(seconds)
+
+
+def reset_stats():
+    # type: () -> None
+    global _loop
+    _loop = Histogram()
+    _ticks.clear()
+    _counters.clear()
+
+
+def report_stats():
+    # type: () -> List[str]
+    if not STATS_ENABLED:
+        return ['Statistics disabled (PhidgetControlsStats.STATS_ENABLED)']
+    lines = ['Flight loop: %s' % _loop.describe()]
+    for label in sorted(_ticks):
+        lines.append('Tick %s: %s' % (label, _ticks[label].describe()))
+    for name in sorted(_counters):
+        lines.append('Count %s: %i' % (name, _counters[name]))
+    return lines
+
+
+def log_stats():
+    # type: () -> None
+    for line in report_stats():
+        logging.info(line)
+
+
+def publish_stats(plugin):
+    # type: (object) -> None
+    from XPLMDefs import XPLM_NO_PLUGIN_ID
+    from XPLMDataAccess import XPLMRegisterDataAccessor, xplmType_Int, xplmType_Float
+    from XPLMPlugin import XPLMFindPluginBySignature, XPLMSendMessageToPlugin
+
+    floats = {
+        'loop_last_us': lambda: _loop.last * 1e6,
+        'loop_mean_us': lambda: _loop.mean() * 1e6,
+        'loop_p99_us': lambda: _loop.percentile(0.99) * 1e6,
+        'loop_max_us': lambda: _loop.max * 1e6}
+    ints = {
+        'loops': lambda: _loop.count,
+        'slow_loops': lambda: _counters.get('slow loops', 0),
+        'exceptions': lambda: _counters.get('exceptions', 0),
+        'phidget_calls': lambda: _counters.get('phidget calls', 0),
+        'phidget_events': lambda: _counters.get('phidget events', 0),
+        'throttled_writes': lambda: _counters.get('throttled writes', 0),
+        'suppressed_writes': lambda: _counters.get('suppressed writes', 0)}
+
+    dataref_editor = XPLMFindPluginBySignature(DATAREF_EDITOR_SIGNATURE)
+    for name, getter in sorted(floats.items()) + sorted(ints.items()):
+        read_int = (lambda _refcon, g=getter: int(g())) if name in ints else None
+        read_float = (lambda _refcon, g=getter: float(g())) if name in floats else None
+        path = STATS_DATAREF_PREFIX + name
+        _callbacks.append((read_int, read_float))
+        _datarefs.append(XPLMRegisterDataAccessor(
+            plugin, path, xplmType_Int if name in ints else xplmType_Float, 0,
+            read_int, None, read_float, None, None, None, None, None, None, None, None, None, 0, 0))
+        if dataref_editor != XPLM_NO_PLUGIN_ID:
+            XPLMSendMessageToPlugin(dataref_editor, DATAREF_EDITOR_MSG_ADD_DATAREF, path)
+
+
+def unpublish_stats(plugin):
+    # type: (object) -> None
+    from XPLMDataAccess import XPLMUnregisterDataAccessor
+    for dataref in _datarefs:
+        XPLMUnregisterDataAccessor(plugin, dataref)
+    del _datarefs[:]
+    del _callbacks[:]
@@ -0,0 +1,335 @@
+"""
+    Phidget Controls UDP - run the plugin outside of X-Plane, e.g. on a cockpit PC with the phidgets attached,
+    writing datarefs and triggering commands over X-Plane's UDP DREF/CMND packets and mirroring dataref values
+    subscribed to via RREF - elements of array datarefs as path[index] each
+
+    Usage:
+      python PhidgetControlsUDP.py [--port 49000] [--mode MODE] [--aircraft PATH] XPLANE_HOST
+      python PhidgetControlsUDP.py --stand-in [--port 49000] HOST     stand-in for X-Plane listening on HOST
+
+    Commands of PhidgetControls (e.g. fscode/phidgetcontrols/COM1 to select a mode) stay local, so Click
+    interactions can select modes.
+"""
+import argparse
+import logging
+import select
+import socket
+import struct
+import sys
+import threading
+from time import time, sleep
+from typing import Dict, List, Optional
+
+from PhidgetControlsSimulator import SimulatedXPlane, FRAME_TIME, XPLM_MSG_PLANE_LOADED, install
+
+# Configuration: X-Plane's UDP port, RREF updates per second asked for, seconds to wait for the first value of a
+# dataref subscribed to, seconds between sends of a changing dataref (coalescing values in between), seconds to
+# ignore RREF updates of a dataref after writing it, and seconds between renewals of subscriptions (in case X-Plane
+# restarted)
+UDP_PORT = 49000
+UDP_RREF_FREQUENCY = 20
+UDP_FIRST_VALUE_TIMEOUT = 1.0
+UDP_SEND_INTERVAL = 0.05
+UDP_ECHO_HOLD = 0.5
+UDP_RESUBSCRIBE_INTERVAL = 10.0
+
+# packets: DREF value and path (509 bytes), CMND path, RREF frequency, index and path (413 bytes),
+# RREF updates as header and index/value pairs
+DREF = struct.Struct('<5sf500s')
+RREF = struct.Struct('<5sii400s')
+RREF_VALUE = struct.Struct('<if')
+RREF_HEADER = 5
+RREF_VALUES_PER_PACKET = 100
+
+
+class UDPXPlane(SimulatedXPlane):
+    """
+        XPLM functions backed by X-Plane over UDP - dataref values mirrored from RREF updates, dataref writes
+        and commands sent at the end of each flight loop. Datarefs are found once their first value is mirrored,
+        those without one in time are missing until it arrives (then found again like after an aircraft load)
+    """
+
+    def __init__(self, host, port=UDP_PORT):
+        # type: (str, int) -> None
+        SimulatedXPlane.__init__(self)
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('', 0))
+        self.socket.setblocking(False)
+        self.paths = []  # type: List[str]
+        self.subscribed = 0.0
+        self.held = {}  # type: Dict[str, float]
+        self.pending = {}  # type: Dict[str, float]
+        self.sent = {}  # type: Dict[str, float]
+        self.outgoing = []  # type: List[str]
+        self.scheduled = {}  # type: Dict[int, float]
+        self.packets = 0
+        self.resolved = False
+
+    # XPLMDataAccess
+    def XPLMFindDataRef(self, path):
+        # e.g. statistics published by the plugin itself
+        if path in self.accessors:
+            return path
+        if path not in self.paths:
+            self.paths.append(path)
+            self.send(RREF.pack('RREF', UDP_RREF_FREQUENCY, len(self.paths) - 1, path))
+
+        # found with a value to read only - compiling waits for it rather than a tick failing on it
+        deadline = time() + UDP_FIRST_VALUE_TIMEOUT
+        while path not in self.datarefs:
+            now = time()
+            if now >= deadline:
+                self.missing.add(path)
+                return None
+            select.select([self.socket], [], [], deadline - now)
+            self.receive(time())
+        return path
+
+    def XPLMGetDatai(self, ref):
+        return int(self.XPLMGetDataf(ref))
+
+    def XPLMGetDataf(self, ref):
+        if ref in self.accessors:
+            return SimulatedXPlane.XPLMGetDataf(self, ref)
+        self.reads += 1
+        value = self.datarefs.get(ref)
+        if value is None:
+            raise LookupError('No value for %s from X-Plane yet' % ref)
+        return value
+
+    def XPLMGetDataRefTypes(self, _ref):
+        # can't tell over UDP - only asked for array datarefs, and RREF values are floats anyway
+        return 8
+
+    def XPLMGetDatavi(self, ref, values, offset, count):
+        return self.XPLMGetDatavf(ref, values, offset, count)
+
+    def XPLMGetDatavf(self, ref, values, offset, count):
+        # elements were all found when the array dataref was (see PhidgetControlsDataRefs._find_array)
+        elements = ['%s[%i]' % (ref, index) for index in range(offset, offset + count)]
+        missing = [element for element in elements if not self.XPLMFindDataRef(element)]
+        if missing:
+            raise LookupError('No value for %s from X-Plane yet' % ', '.join(missing))
+        values.extend(self.XPLMGetDataf(element) for element in elements)
+        return count
+
+    def XPLMSetDatavi(self, ref, values, offset, count):
+        self.XPLMSetDatavf(ref, values, offset, count)
+
+    def XPLMSetDatavf(self, ref, values, offset, count):
+        for index in range(count):
+            self.XPLMSetDataf(self.XPLMFindDataRef('%s[%i]' % (ref, offset + index)), values[index])
+
+    def XPLMSetDatai(self, ref, value):
+        self.XPLMSetDataf(ref, value)
+
+    def XPLMSetDataf(self, ref, value):
+        self.writes += 1
+        self.datarefs[ref] = self.pending[ref] = float(value)
+        self.held[ref] = time() + UDP_ECHO_HOLD
+
+    # XPLMUtilities
+    def XPLMCommandOnce(self, command):
+        # own commands run locally
+        if command in self.handlers:
+            return SimulatedXPlane.XPLMCommandOnce(self, command)
+        self.commands.append((self.loop, command))
+        self.outgoing.append(command)
+
+    def send(self, packet):
+        # type: (str) -> None
+        try:
+            self.socket.sendto(packet, self.address)
+            self.packets += 1
+        except socket.error as error:
+            logging.debug("Can't send to %s:%i: %s", self.address[0], self.address[1], error)
+
+    def receive(self, now):
+        # type: (float) -> None
+        while True:
+            try:
+                packet = self.socket.recv(65536)
+            except socket.error:
+                return
+            if packet[:4] != 'RREF':
+                continue
+            for offset in range(RREF_HEADER, len(packet) - RREF_VALUE.size + 1, RREF_VALUE.size):
+                index, value = RREF_VALUE.unpack_from(packet, offset)
+                if 0 <= index < len(self.paths):
+                    path = self.paths[index]
+                    # our own writes win until X-Plane had time to apply them
+                    if now >= self.held.get(path, 0.0):
+                        self.datarefs[path] = value
+                    if path in self.missing:
+                        self.missing.discard(path)
+                        self.resolved = True
+
+    def flush(self, now):
+        # type: (float) -> float
+        # send commands and (coalesced) dataref writes, returns seconds until throttled writes are due
+        for command in self.outgoing:
+            self.send('CMND\0' + command)
+        del self.outgoing[:]
+
+        due = UDP_RESUBSCRIBE_INTERVAL
+        for path, value in list(self.pending.items()):
+            wait = self.sent.get(path, 0.0) + UDP_SEND_INTERVAL - now
+            if wait > 0:
+                due = min(due, wait)
+                continue
+            self.send(DREF.pack('DREF', value, path))
+            self.sent[path] = now
+            del self.pending[path]
+
+        # renew subscriptions now and then
+        if now - self.subscribed > UDP_RESUBSCRIBE_INTERVAL:
+            self.subscribed = now
+            for index, path in enumerate(self.paths):
+                self.send(RREF.pack('RREF', UDP_RREF_FREQUENCY, index, path))
+        return due
+
+    def run(self, stopping, plugin=None):
+        # type: (threading.Event, Optional[object]) -> None
+        # flight loops as scheduled, waking up for RREF updates
+        while not stopping.is_set():
+            now = time()
+            self.receive(now)
+
+            # datarefs missing before have values now? find them again like after an aircraft load
+            if self.resolved and plugin:
+                self.resolved = False
+                plugin.XPluginReceiveMessage(None, XPLM_MSG_PLANE_LOADED, 0)
+
+            self.loop += 1
+            for flight_loop, (callback, interval, refcon) in list(self.flight_loops.items()):
+                last = self.scheduled.get(flight_loop)
+                elapsed = interval if interval > 0 else -interval * FRAME_TIME
+                if last is None or now - last >= elapsed:
+                    self.scheduled[flight_loop] = now
+                    self.flight_loops[flight_loop][1] = callback(now - last if last else elapsed, 0.0, self.loop,
+                                                                 refcon)
+            timeout = self.flush(time())
+            for flight_loop, (_, interval, _) in self.flight_loops.items():
+                elapsed = interval if interval > 0 else -interval * FRAME_TIME
+                timeout = min(timeout, self.scheduled.get(flight_loop, now) + elapsed - time())
+            select.select([self.socket], [], [], max(0.0, timeout))
+
+    def close(self):
+        # type: () -> None
+        for index, path in enumerate(self.paths):
+            self.send(RREF.pack('RREF', 0, index, path))
+        self.socket.close()
+
+
+class UDPStandIn(threading.Thread):
+    """
+        Stands in for X-Plane's UDP interface - applies DREF, records CMND and sends RREF updates
+    """
+
+    def __init__(self, host='127.0.0.1', port=UDP_PORT):
+        # type: (str, int) -> None
+        threading.Thread.__init__(self, name='PhidgetControlsUDPStandIn')
+        self.daemon = True
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.stopping = False
+        self.datarefs = {}  # type: Dict[str, float]
+        self.commands = []  # type: List[str]
+        self.subscriptions = {}  # type: Dict[tuple, Dict[int, list]]
+        self.packets = 0
+
+    def stop(self):
+        # type: () -> None
+        self.stopping = True
+        self.join()
+        self.socket.close()
+
+    def run(self):
+        # type: () -> None
+        while not self.stopping:
+            if select.select([self.socket], [], [], 0.01)[0]:
+                packet, address = self.socket.recvfrom(65536)
+                self.packets += 1
+                self.handle(packet, address)
+            self.update(time())
+
+    def handle(self, packet, address):
+        # type: (str, tuple) -> None
+        if packet[:5] == 'DREF\0' and len(packet) >= DREF.size:
+            _, value, path = DREF.unpack_from(packet)
+            self.datarefs[path.split('\0', 1)[0]] = value
+        elif packet[:5] == 'CMND\0':
+            self.commands.append(packet[5:].split('\0', 1)[0])
+        elif packet[:5] == 'RREF\0' and len(packet) >= RREF.size:
+            _, frequency, index, path = RREF.unpack_from(packet)
+            subscriptions = self.subscriptions.setdefault(address, {})
+            if frequency:
+                subscriptions[index] = [path.split('\0', 1)[0], 1.0 / frequency, 0.0]
+            else:
+                subscriptions.pop(index, None)
+
+    def update(self, now):
+        # type: (float) -> None
+        for address, subscriptions in self.subscriptions.items():
+            values = []
+            for index, subscription in subscriptions.items():
+                path, interval, last = subscription
+                if now - last >= interval:
+                    subscription[2] = now
+                    values.append(RREF_VALUE.pack(index, self.datarefs.get(path, 0.0)))
+            for start in range(0, len(values), RREF_VALUES_PER_PACKET):
+                self.socket.sendto('RREF,' + ''.join(values[start:start + RREF_VALUES_PER_PACKET]), address)
+
+
+def start(xplane, mode=None):
+    # type: (UDPXPlane, Optional[str]) -> object
+    from PI_PhidgetControls import PythonInterface
+    plugin = PythonInterface()
+    plugin.XPluginStart()
+    plugin.XPluginEnable()
+    if mode:
+        xplane.XPLMCommandOnce('fscode/phidgetcontrols/' + mode)
+    return plugin
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run PhidgetControls against X-Plane over UDP')
+    parser.add_argument('host', help='X-Plane host (or host to listen on with --stand-in)')
+    parser.add_argument('--port', type=int, default=UDP_PORT, help='X-Plane UDP port')
+    parser.add_argument('--mode', help='interaction mode to start with')
+    parser.add_argument('--aircraft', default='', help='path of aircraft flown, for its profile')
+    parser.add_argument('--stand-in', action='store_true', help='stand in for X-Plane instead')
+    args = parser.parse_args(argv)
+
+    if args.stand_in:
+        stand_in = UDPStandIn(args.host, args.port)
+        stand_in.start()
+        try:
+            while True:
+                sleep(1.0)
+                for command in stand_in.commands:
+                    print(command)
+                del stand_in.commands[:]
+                for path in sorted(stand_in.datarefs):
+                    print('%s = %s' % (path, stand_in.datarefs[path]))
+        except KeyboardInterrupt:
+            stand_in.stop()
+        return
+
+    xplane = UDPXPlane(args.host, args.port)
+    xplane.aircraft = args.aircraft
+    install(xplane, virtual_phidgets=False)
+    plugin = start(xplane, args.mode)
+    stopping = threading.Event()
+    try:
+        xplane.run(stopping, plugin)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        plugin.XPluginStop()
+        xplane.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
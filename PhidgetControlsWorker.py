@@ -0,0 +1,381 @@
+"""
+    Phidget Controls Worker - owns phidgets in a helper process, streaming position changes and state edges
+    into a memory-mapped single-producer/single-consumer ring buffer that the flight loop reads without
+    locks or system calls
+
+    Started (and restarted) by the plugin if PhidgetControlsCache.WORKER_INPUT is set:
+      python PhidgetControlsWorker.py [--fake] RING Encoder:82081 DigitalInput:620001:3:-1:1 ...
+
+    Phidgets are given as type:serial[:hub port:channel:hub port device].
+
+    With --fake no phidgets are opened, encoders turn and digital inputs toggle randomly instead.
+"""
+import argparse
+import logging
+import mmap
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Callable, Optional
+
+from PhidgetControlsInput import InputAccumulator, InputChannel, Device
+
+# Configuration: python interpreter running the worker (X-Plane itself can't), and fake input for testing
+WORKER_PYTHON = os.path.join(sys.prefix, 'python.exe') if os.name == 'nt' else os.path.join(sys.prefix, 'bin', 'python')
+WORKER_FAKE = False
+
+# Configuration: records in ring buffer, seconds between checks of the worker (and heartbeats to it), seconds
+# between restarts of a failing worker doubling up to max, seconds without heartbeat until the worker quits
+RING_CAPACITY = 4096
+WORKER_CHECK_INTERVAL = 1.0
+WORKER_RESTART_BACKOFF_MIN = 1.0
+WORKER_RESTART_BACKOFF_MAX = 32.0
+WORKER_TIMEOUT = 5.0
+
+# phidget types by code in records
+WORKER_TYPES = ('Encoder', 'DigitalInput')
+
+# record kinds - value is position change, state, or attached
+POSITION_CHANGE, STATE_CHANGE, ATTACHED = 0, 1, 2
+
+# header: magic, capacity, records written, records read, records dropped, heartbeat - then records
+MAGIC = 'PCR1'
+HEADER = struct.Struct('<4sIQQQd')
+HEADER_SIZE = 64
+WRITTEN, READ, DROPPED, HEARTBEAT = 8, 16, 24, 32
+COUNTER = struct.Struct('<Q')
+TIMESTAMP = struct.Struct('<d')
+
+# record: timestamp, serial, value, type code, kind, hub port, channel, hub port device
+RECORD = struct.Struct('<diiBBbbB3x')
+
+
+class RingBuffer(object):
+    """
+        Fixed-size records in a memory-mapped file - the producer only advances the written counter after
+        a record is complete, the consumer only advances the read counter
+    """
+
+    def __init__(self, path, capacity=None):
+        # type: (str, Optional[int]) -> None
+        self.path = path
+        if capacity:
+            with open(path, 'wb') as ring_file:
+                ring_file.write(HEADER.pack(MAGIC, capacity, 0, 0, 0, time.time()).ljust(HEADER_SIZE, '\0'))
+                ring_file.truncate(HEADER_SIZE + capacity * RECORD.size)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.capacity, _, _, _, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a ring buffer %s' % path)
+
+    def close(self, remove=False):
+        # type: (bool) -> None
+        self.map.close()
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+    def write(self, timestamp, address, value, kind):
+        # type: (float, tuple, int, int) -> bool
+        written = COUNTER.unpack_from(self.map, WRITTEN)[0]
+        if written - COUNTER.unpack_from(self.map, READ)[0] >= self.capacity:
+            COUNTER.pack_into(self.map, DROPPED, COUNTER.unpack_from(self.map, DROPPED)[0] + 1)
+            return False
+        type_code, serial, hub_port, channel, hub_port_device = address
+        RECORD.pack_into(self.map, HEADER_SIZE + (written % self.capacity) * RECORD.size,
+                         timestamp, serial, value, type_code, kind, hub_port, channel, hub_port_device)
+        COUNTER.pack_into(self.map, WRITTEN, written + 1)
+        return True
+
+    def read(self):
+        # type: () -> List[tuple]
+        written = COUNTER.unpack_from(self.map, WRITTEN)[0]
+        read = COUNTER.unpack_from(self.map, READ)[0]
+        if written == read:
+            return []
+        records = [RECORD.unpack_from(self.map, HEADER_SIZE + (index % self.capacity) * RECORD.size)
+                   for index in xrange(read, written)]
+        COUNTER.pack_into(self.map, READ, written)
+        return records
+
+    def dropped(self):
+        # type: () -> int
+        return COUNTER.unpack_from(self.map, DROPPED)[0]
+
+    def heartbeat(self):
+        # type: () -> None
+        TIMESTAMP.pack_into(self.map, HEARTBEAT, time.time())
+
+    def getHeartbeat(self):
+        # type: () -> float
+        return TIMESTAMP.unpack_from(self.map, HEARTBEAT)[0]
+
+
+class RingInputAccumulator(InputAccumulator):
+    """
+        Changes streamed by the worker, published to channels on drain() like InputAccumulator's
+    """
+
+    def __init__(self, attached):
+        # type: (Callable[[object, bool], None]) -> None
+        InputAccumulator.__init__(self)
+        self.ring = RingBuffer(os.path.join(tempfile.gettempdir(), 'PhidgetControls.%i.ring' % os.getpid()),
+                               RING_CAPACITY)
+        self.attached = attached
+        self.keys = {}  # type: Dict[tuple, Device]
+
+    def close(self):
+        # type: () -> None
+        self.ring.close(remove=True)
+
+    def channel(self, key):
+        # type: (Device) -> InputChannel
+        self.keys[(WORKER_TYPES.index(key.type.__name__), key.serial, key.hub_port, key.channel,
+                   int(key.hub_port_device))] = key
+        return InputAccumulator.channel(self, key)
+
+    def devices(self):
+        # type: () -> List[str]
+        # called from the supervisor while the sim thread may add keys
+        return sorted('%s:%i:%i:%i:%i' % ((WORKER_TYPES[address[0]],) + address[1:]) for address in list(self.keys))
+
+    def drain(self):
+        # type: () -> List[InputChannel]
+
+        # changes of the previous drain are done
+        for channel in self.drained:
+            channel.changes = []
+
+        records = self.ring.read()
+        if not records:
+            self.drained = []
+            return self.drained
+
+        # publish to channels
+        drained = {}
+        for timestamp, serial, value, type_code, kind, hub_port, channel, hub_port_device in records:
+            key = self.keys.get((type_code, serial, hub_port, channel, hub_port_device))
+            if key is None:
+                continue
+            if kind == ATTACHED:
+                self.attached(key, bool(value))
+                continue
+            channel = self.channels[key]
+            if kind == POSITION_CHANGE:
+                channel.position += value
+            else:
+                channel.state = value
+            channel.changes.append((timestamp, value))
+            drained[key] = channel
+
+        for channel in drained.values():
+            channel.sequence += 1
+        self.drained = list(drained.values())
+        return self.drained
+
+
+class WorkerSupervisor(threading.Thread):
+    """
+        Runs the worker process for the phidgets asked for - restarting it when it exits (with backoff)
+        or when phidgets are added
+    """
+
+    def __init__(self, inputs):
+        # type: (RingInputAccumulator) -> None
+        threading.Thread.__init__(self, name='PhidgetControlsWorkerSupervisor')
+        self.daemon = True
+        self.inputs = inputs
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.process = None  # type: Optional[subprocess.Popen]
+        self.devices = []  # type: List[str]
+        self.started = 0.0
+        self.next_start = 0.0
+        self.backoff = WORKER_RESTART_BACKOFF_MIN
+        self.dropped = 0
+
+    def stop(self):
+        # type: () -> None
+        self.stopping = True
+        self.wakeup.set()
+        self.join()
+        self.terminate()
+
+    def run(self):
+        # type: () -> None
+        while not self.stopping:
+            self.wakeup.clear()
+            # keep supervising (and the heartbeat the worker quits without) whatever goes wrong
+            try:
+                self.inputs.ring.heartbeat()
+                timeout = self.supervise(time.time())
+            except Exception as exception:
+                logging.exception(exception)
+                timeout = WORKER_CHECK_INTERVAL
+            self.wakeup.wait(timeout)
+
+    def supervise(self, now):
+        # type: (float) -> float
+
+        dropped = self.inputs.ring.dropped()
+        if dropped != self.dropped:
+            logging.warning('Phidget worker dropped %i changes', dropped - self.dropped)
+            self.dropped = dropped
+
+        # running for the phidgets asked for?
+        devices = self.inputs.devices()
+        if self.process and self.process.poll() is None:
+            if devices == self.devices:
+                return WORKER_CHECK_INTERVAL
+            logging.info('Restarting phidget worker for %s', ' '.join(devices))
+            self.terminate()
+
+        # exited? restart after backoff unless it ran for a while
+        if self.process:
+            logging.warning('Phidget worker exited (%s)', self.process.returncode)
+            self.process = None
+            if now - self.started > WORKER_RESTART_BACKOFF_MAX:
+                self.backoff = WORKER_RESTART_BACKOFF_MIN
+            self.next_start = now + self.backoff
+            self.backoff = min(self.backoff * 2, WORKER_RESTART_BACKOFF_MAX)
+
+        if not devices:
+            return WORKER_CHECK_INTERVAL
+        if now < self.next_start:
+            return min(WORKER_CHECK_INTERVAL, self.next_start - now)
+
+        args = [WORKER_PYTHON, os.path.splitext(os.path.abspath(__file__))[0] + '.py', self.inputs.ring.path]
+        if WORKER_FAKE:
+            args.insert(2, '--fake')
+        logging.debug('Starting %s', ' '.join(args + devices))
+        self.devices = devices
+        self.started = now
+        try:
+            if os.name == 'nt':
+                self.process = subprocess.Popen(args + devices, creationflags=0x08000000)  # CREATE_NO_WINDOW
+            else:
+                self.process = subprocess.Popen(args + devices, close_fds=True)
+        except OSError as error:
+            logging.error("Can't start phidget worker %s: %s", WORKER_PYTHON, error)
+            self.next_start = now + self.backoff
+            self.backoff = min(self.backoff * 2, WORKER_RESTART_BACKOFF_MAX)
+        return WORKER_CHECK_INTERVAL
+
+    def terminate(self):
+        # type: () -> None
+        if not self.process:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.process = None
+
+
+def open_phidgets(devices, write):
+    # type: (List[tuple], Callable) -> list
+    from Phidget22.Devices.Encoder import Encoder
+    from Phidget22.Devices.DigitalInput import DigitalInput
+    from Phidget22.PhidgetException import PhidgetException
+
+    phidget_types = {'Encoder': Encoder, 'DigitalInput': DigitalInput}
+    phidgets = []
+    for address in devices:
+        type_code, serial, hub_port, channel, hub_port_device = address
+        phidget = phidget_types[WORKER_TYPES[type_code]]()
+        phidget.setDeviceSerialNumber(serial)
+        if hub_port >= 0:
+            phidget.setHubPort(hub_port)
+            phidget.setIsHubPortDevice(bool(hub_port_device))
+        if channel >= 0:
+            phidget.setChannel(channel)
+        phidget.setOnAttachHandler(lambda _ch, a=address: write(a, 1, ATTACHED))
+        phidget.setOnDetachHandler(lambda _ch, a=address: write(a, 0, ATTACHED))
+        if hasattr(phidget, 'setOnPositionChangeHandler'):
+            phidget.setOnPositionChangeHandler(
+                lambda _ch, position_change, _time_change, _index_triggered, a=address: write(
+                    a, position_change, POSITION_CHANGE))
+        if hasattr(phidget, 'setOnStateChangeHandler'):
+            phidget.setOnStateChangeHandler(lambda _ch, state, a=address: write(a, int(state), STATE_CHANGE))
+        try:
+            # attaches (and re-attaches) asynchronously
+            phidget.open()
+        except PhidgetException as e:
+            logging.error('%s#%i: %s (%i)', WORKER_TYPES[type_code], serial, e.description, e.code)
+        phidgets.append(phidget)
+    return phidgets
+
+
+class FakeProducer(object):
+    """
+        Turns encoders and toggles digital inputs randomly
+    """
+
+    def __init__(self, devices, write):
+        # type: (List[tuple], Callable) -> None
+        self.devices = devices
+        self.write = write
+        self.random = random.Random(0)
+        self.states = {}  # type: Dict[tuple, int]
+        for address in devices:
+            write(address, 1, ATTACHED)
+
+    def produce(self):
+        # type: () -> None
+        for address in self.devices:
+            if WORKER_TYPES[address[0]] == 'Encoder':
+                self.write(address, self.random.choice((-4, -2, -1, 1, 2, 4)), POSITION_CHANGE)
+            elif self.random.random() < 0.02:
+                state = self.states[address] = 1 - self.states.get(address, 0)
+                self.write(address, state, STATE_CHANGE)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Stream phidget input into a PhidgetControls ring buffer')
+    parser.add_argument('--fake', action='store_true', help='fake input instead of opening phidgets')
+    parser.add_argument('ring', help='ring buffer file created by the plugin')
+    parser.add_argument('devices', nargs='+', help='phidgets as type:serial[:hub port:channel:hub port device]')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='PhidgetControlsWorker: %(message)s')
+
+    ring = RingBuffer(args.ring)
+    devices = [_address(device) for device in args.devices]
+
+    # one producer - phidget handlers run on several threads
+    lock = threading.Lock()
+
+    def write(address, value, kind):
+        with lock:
+            ring.write(time.time(), address, value, kind)
+
+    fake = FakeProducer(devices, write) if args.fake else None
+    phidgets = open_phidgets(devices, write) if not args.fake else []
+
+    # until the plugin stops heartbeating
+    while time.time() - ring.getHeartbeat() < WORKER_TIMEOUT:
+        if fake:
+            fake.produce()
+            time.sleep(0.01)
+        else:
+            time.sleep(WORKER_CHECK_INTERVAL)
+
+    for phidget in phidgets:
+        phidget.close()
+    ring.close()
+
+
+def _address(device):
+    # type: (str) -> tuple
+    # e.g. Encoder:82081 or DigitalInput:620001:3:-1:1 as (type code, serial, hub port, channel, hub port device)
+    fields = device.split(':')
+    numbers = [int(field) for field in fields[1:]] + [-1, -1, 0][len(fields) - 2:]
+    return tuple([WORKER_TYPES.index(fields[0])] + numbers)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])